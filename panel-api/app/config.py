@@ -5,6 +5,22 @@ class Settings(BaseSettings):
     database_url: str | None = None
     gcs_bucket: str | None = None
     internal_api_token: str | None = None
+    # Processes used for URL signing (SIGN_WORKERS); 0 signs in the default thread pool.
+    sign_workers: int = 2
+    # Per-IP limit on /api/upload/signed-url (SIGNED_URL_RATE_LIMIT), slowapi syntax.
+    signed_url_rate_limit: str = "60/minute"
+
+    # Connection pool (DB_* env vars). Behind PgBouncer (transaction mode) keep
+    # connections short-lived and skip pre-ping, which leaves them idle in transaction.
+    db_pool_size: int = 10
+    db_max_overflow: int = 5
+    db_pool_timeout: int = 30
+    db_pool_recycle: int | None = None  # default: 60 behind PgBouncer, 1800 otherwise
+    db_pool_pre_ping: bool | None = None  # default: off behind PgBouncer, on otherwise
+    db_behind_pgbouncer: bool = False
+    db_null_pool: bool = False
+    # Run Base.metadata.create_all at startup (dev only), under a Postgres advisory lock.
+    db_auto_create: bool = False
 
     class Config:
         env_file = ".env"
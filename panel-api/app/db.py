@@ -1,8 +1,10 @@
 from __future__ import annotations
 
-from contextlib import contextmanager
-from sqlalchemy import create_engine
-from sqlalchemy.orm import sessionmaker
+from contextlib import asynccontextmanager
+from uuid import uuid4
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import AsyncSession, async_sessionmaker, create_async_engine
+from sqlalchemy.pool import NullPool
 
 from .config import settings
 
@@ -10,22 +12,60 @@ from .config import settings
 _engine = None
 SessionLocal = None
 
+
+def _async_database_url(url: str) -> str:
+    """Point plain/psycopg2 Postgres URLs at the asyncpg driver."""
+    u = make_url(url)
+    if u.drivername in ("postgres", "postgresql", "postgresql+psycopg2"):
+        u = u.set(drivername="postgresql+asyncpg")
+    return u.render_as_string(hide_password=False)
+
+
+def _unique_statement_name() -> str:
+    return f"__asyncpg_{uuid4()}__"
+
+
+def _engine_kwargs() -> dict:
+    pgbouncer = settings.db_behind_pgbouncer
+    kwargs: dict = {
+        "pool_pre_ping": (not pgbouncer) if settings.db_pool_pre_ping is None else settings.db_pool_pre_ping,
+    }
+    if pgbouncer:
+        # PgBouncer in transaction mode cannot keep prepared statements: turn off both
+        # asyncpg's cache and SQLAlchemy's dialect cache, and give every statement a
+        # unique name so two server connections never see the same one.
+        kwargs["connect_args"] = {
+            "statement_cache_size": 0,
+            "prepared_statement_cache_size": 0,
+            "prepared_statement_name_func": _unique_statement_name,
+        }
+    if settings.db_null_pool:
+        kwargs["poolclass"] = NullPool
+        return kwargs
+    kwargs.update(
+        pool_size=settings.db_pool_size,
+        max_overflow=settings.db_max_overflow,
+        pool_timeout=settings.db_pool_timeout,
+        pool_recycle=settings.db_pool_recycle if settings.db_pool_recycle is not None else (60 if pgbouncer else 1800),
+    )
+    return kwargs
+
+
 if settings.database_url:
-    _engine = create_engine(settings.database_url, pool_pre_ping=True)
-    SessionLocal = sessionmaker(bind=_engine, autoflush=False, autocommit=False)
+    _engine = create_async_engine(_async_database_url(settings.database_url), **_engine_kwargs())
+    SessionLocal = async_sessionmaker(bind=_engine, autoflush=False, expire_on_commit=False, class_=AsyncSession)
 
 
-@contextmanager
-def session_scope():
+@asynccontextmanager
+async def session_scope():
     if SessionLocal is None:
         raise RuntimeError("DATABASE_URL not configured")
     session = SessionLocal()
     try:
         yield session
-        session.commit()
+        await session.commit()
     except Exception:
-        session.rollback()
+        await session.rollback()
         raise
     finally:
-        session.close()
-
+        await session.close()
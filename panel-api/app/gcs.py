@@ -0,0 +1,39 @@
+"""GCS signed URLs.
+
+Kept apart from ``main`` so signing worker processes only import storage and settings.
+"""
+from __future__ import annotations
+
+import threading
+from datetime import timedelta
+from typing import Optional
+
+from google.cloud import storage
+
+from .config import settings
+
+# One storage client per process: building it runs ADC credential discovery.
+_gcs_client = None
+_gcs_bucket = None
+_gcs_lock = threading.Lock()
+
+
+def _get_bucket():
+    global _gcs_client, _gcs_bucket
+    if _gcs_bucket is None:
+        with _gcs_lock:
+            if _gcs_bucket is None:
+                _gcs_client = storage.Client()
+                _gcs_bucket = _gcs_client.bucket(settings.gcs_bucket)
+    return _gcs_bucket
+
+
+def signed_url(object_name: str, method: str = "PUT", content_type: Optional[str] = None, expires_in: int = 15*60) -> str:
+    """Sign a v4 URL for ``object_name`` (uses ADC in prod). CPU-bound: RSA signing."""
+    blob = _get_bucket().blob(object_name)
+    return blob.generate_signed_url(
+        version="v4",
+        expiration=timedelta(seconds=expires_in),
+        method=method,
+        content_type=content_type if method.upper() == "PUT" else None,
+    )
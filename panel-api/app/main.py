@@ -1,24 +1,62 @@
 from __future__ import annotations
 
-import json
-from datetime import timedelta
-from typing import Optional
-
-from fastapi import FastAPI, HTTPException, Depends, Header
-from sqlalchemy import select
+import asyncio
+import functools
+import multiprocessing
+import time
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import asynccontextmanager
+from typing import List, Optional
+
+from fastapi import FastAPI, HTTPException, Depends, Header, Request
+from slowapi import Limiter, _rate_limit_exceeded_handler
+from slowapi.errors import RateLimitExceeded
+from slowapi.util import get_remote_address
+from sqlalchemy import func, insert, literal_column, or_, select
+from sqlalchemy.dialects.postgresql import insert as pg_insert
 
 from .config import settings
 from .db import session_scope, _engine
+from .gcs import signed_url
 from .models import Base, Lead, Event
 from .schemas import LeadUpsertRequest, LeadResponse, LeadsListResponse, SignedUrlRequest, SignedUrlResponse
 from .utils import gen_token
 
-app = FastAPI(title="CoopMob Panel API", version="0.1.0")
+# RSA signing is CPU-bound and holds the GIL; run it in worker processes so a burst
+# of cache misses does not stall the event loop. "spawn" keeps workers from inheriting
+# the loop and DB pool; they only import app.gcs. 0 workers signs in a thread instead.
+_sign_pool: Optional[ProcessPoolExecutor] = None
+
+# Arbitrary app-wide key for pg_advisory_xact_lock around create_all.
+_CREATE_ALL_LOCK_KEY = 0x436F6F704D6F62
+
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global _sign_pool
+    # Dev bootstrap only (DB_AUTO_CREATE=1). Every worker runs it, serialized by a
+    # transaction-scoped advisory lock: the first creates the tables, the others wait
+    # and then find them already there. In prod the schema comes from migrations.
+    if _engine is not None and settings.db_auto_create:
+        async with _engine.begin() as conn:
+            await conn.execute(select(func.pg_advisory_xact_lock(_CREATE_ALL_LOCK_KEY)))
+            await conn.run_sync(Base.metadata.create_all)
+    if settings.sign_workers > 0:
+        _sign_pool = ProcessPoolExecutor(max_workers=settings.sign_workers, mp_context=multiprocessing.get_context("spawn"))
+    yield
+    if _sign_pool is not None:
+        _sign_pool.shutdown(cancel_futures=True)
+        _sign_pool = None
+    if _engine is not None:
+        await _engine.dispose()
 
 
-# Initialize tables lazily if engine exists (dev bootstrap). In prod, prefer migrations.
-if _engine is not None:
-    Base.metadata.create_all(_engine)
+app = FastAPI(title="CoopMob Panel API", version="0.1.0", lifespan=lifespan)
+
+# Per-IP limits (in-memory, per worker) for the CPU-heavy endpoints.
+limiter = Limiter(key_func=get_remote_address)
+app.state.limiter = limiter
+app.add_exception_handler(RateLimitExceeded, _rate_limit_exceeded_handler)
 
 
 def _auth_guard(authorization: Optional[str] = Header(default=None)):
@@ -32,7 +70,7 @@ def _auth_guard(authorization: Optional[str] = Header(default=None)):
 
 
 @app.get("/health")
-def health():
+async def health():
     return {
         "status": "ok",
         "db": bool(_engine is not None),
@@ -40,50 +78,84 @@ def health():
     }
 
 
+LEADS_BATCH_MAX = 500
+
+
+async def _upsert_leads(s, payloads: List[LeadUpsertRequest]) -> list:
+    """Upsert leads by phone in one INSERT ... ON CONFLICT and log one event per lead.
+
+    Empty fields never overwrite stored values and the form token is only set
+    when the lead does not have one yet. Returns the RETURNING rows, in input order.
+    """
+    rows: dict[str, dict] = {}
+    for p in payloads:
+        phone = p.phone.strip()
+        if not phone:
+            raise HTTPException(status_code=400, detail="phone required")
+        values = {
+            "phone": phone,
+            "name": p.name or None,
+            "email": p.email or None,
+            "city": p.city or None,
+            "source": p.source or None,
+            "form_token": gen_token(16),
+        }
+        prev = rows.get(phone)
+        if prev:
+            # Same phone twice in a batch: ON CONFLICT cannot touch a row twice, so merge.
+            values = {k: values[k] or prev[k] for k in values}
+            values["form_token"] = prev["form_token"]
+        rows[phone] = values
+
+    stmt = pg_insert(Lead).values(list(rows.values()))
+    excluded = stmt.excluded
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[Lead.phone],
+        set_={
+            "name": func.coalesce(excluded.name, Lead.name),
+            "email": func.coalesce(excluded.email, Lead.email),
+            "city": func.coalesce(excluded.city, Lead.city),
+            "source": func.coalesce(excluded.source, Lead.source),
+            "form_token": func.coalesce(Lead.form_token, excluded.form_token),
+        },
+    ).returning(
+        Lead.id, Lead.phone, Lead.name, Lead.email, Lead.city, Lead.step, Lead.status, Lead.form_token,
+        literal_column("xmax = 0").label("inserted"),
+    )
+    by_phone = {r.phone: r for r in (await s.execute(stmt)).all()}
+
+    await s.execute(insert(Event), [
+        {
+            "actor": "system",
+            "kind": "lead_created" if by_phone[p.phone.strip()].inserted else "lead_updated",
+            "lead_id": by_phone[p.phone.strip()].id,
+            "payload": p.model_dump(mode="json"),
+        }
+        for p in payloads
+    ])
+    return [by_phone[p.phone.strip()] for p in payloads]
+
+
 @app.post("/api/leads", response_model=LeadResponse)
-def upsert_lead(payload: LeadUpsertRequest):
-    phone = payload.phone.strip()
-    if not phone:
-        raise HTTPException(status_code=400, detail="phone required")
-    with session_scope() as s:
-        lead = s.execute(select(Lead).where(Lead.phone == phone)).scalar_one_or_none()
-        created = False
-        if not lead:
-            lead = Lead(phone=phone)
-            created = True
-        if payload.name:
-            lead.name = payload.name
-        if payload.email:
-            lead.email = payload.email
-        if payload.city:
-            lead.city = payload.city
-        if payload.source:
-            lead.source = payload.source
-        if not lead.form_token:
-            lead.form_token = gen_token(16)
-        s.add(lead)
-        s.flush()
-
-        ev = Event(actor="system", kind="lead_created" if created else "lead_updated", lead_id=lead.id,
-                   payload=json.dumps(payload.model_dump(), ensure_ascii=False))
-        s.add(ev)
-        s.flush()
-
-        return LeadResponse(
-            id=lead.id,
-            phone=lead.phone,
-            name=lead.name,
-            email=lead.email,
-            city=lead.city,
-            step=lead.step,
-            status=lead.status,
-            form_token=lead.form_token,
-        )
+async def upsert_lead(payload: LeadUpsertRequest):
+    async with session_scope() as s:
+        (row,) = await _upsert_leads(s, [payload])
+        return LeadResponse.model_validate(row)
+
+
+@app.post("/api/leads/batch", response_model=List[LeadResponse])
+async def upsert_leads_batch(payloads: List[LeadUpsertRequest]):
+    if not payloads:
+        return []
+    if len(payloads) > LEADS_BATCH_MAX:
+        raise HTTPException(status_code=400, detail=f"at most {LEADS_BATCH_MAX} leads per batch")
+    async with session_scope() as s:
+        return [LeadResponse.model_validate(row) for row in await _upsert_leads(s, payloads)]
 
 
 @app.get("/api/leads", response_model=LeadsListResponse)
-def list_leads(city: Optional[str] = None, status: Optional[str] = None, q: Optional[str] = None, limit: int = 50, offset: int = 0):
-    with session_scope() as s:
+async def list_leads(city: Optional[str] = None, status: Optional[str] = None, q: Optional[str] = None, limit: int = 50, offset: int = 0):
+    async with session_scope() as s:
         stmt = select(Lead)
         if city:
             stmt = stmt.where(Lead.city == city)
@@ -91,41 +163,47 @@ def list_leads(city: Optional[str] = None, status: Optional[str] = None, q: Opti
             stmt = stmt.where(Lead.status == status)
         if q:
             like = f"%{q}%"
-            from sqlalchemy import or_
             stmt = stmt.where(or_(Lead.name.ilike(like), Lead.phone.ilike(like), Lead.email.ilike(like)))
-        total = s.execute(stmt).scalars().all()
-        items = total[offset:offset+limit]
+        total = (await s.execute(select(func.count()).select_from(stmt.subquery()))).scalar_one()
+        page = stmt.order_by(Lead.created_at.desc(), Lead.id.desc()).limit(limit).offset(offset)
+        items = (await s.execute(page)).scalars().all()
         return LeadsListResponse(
-            total=len(total),
-            items=[LeadResponse(
-                id=x.id, phone=x.phone, name=x.name, email=x.email, city=x.city, step=x.step, status=x.status, form_token=x.form_token
-            ) for x in items]
+            total=total,
+            items=[LeadResponse.model_validate(x) for x in items]
         )
 
 
-# Signed URL helper (uses ADC in prod). If credentials missing, raise 500 with hint.
-def _signed_url(object_name: str, method: str = "PUT", content_type: Optional[str] = None, expires_in: int = 15*60) -> str:
-    from google.cloud import storage
+SIGNED_URL_TTL = 15*60
+_SIGNED_URL_CACHE_MAX = 4096
+# (object_name, method, content_type) -> (url, expires_at monotonic)
+_SIGNED_URL_CACHE: dict[tuple[str, str, Optional[str]], tuple[str, float]] = {}
 
+
+async def _cached_signed_url(object_name: str, method: str, content_type: Optional[str]) -> tuple[str, int]:
+    """Reuse a signed URL while it still has more than half of its lifetime left.
+
+    Returns the URL and its remaining validity in seconds.
+    """
+    key = (object_name, method, content_type)
+    now = time.monotonic()
+    hit = _SIGNED_URL_CACHE.get(key)
+    if hit and hit[1] - now > SIGNED_URL_TTL / 2:
+        return hit[0], int(hit[1] - now)
     if not settings.gcs_bucket:
         raise HTTPException(status_code=500, detail="GCS_BUCKET not configured")
-
-    client = storage.Client()
-    bucket = client.bucket(settings.gcs_bucket)
-    blob = bucket.blob(object_name)
-    url = blob.generate_signed_url(
-        version="v4",
-        expiration=timedelta(seconds=expires_in),
-        method=method,
-        content_type=content_type if method.upper() == "PUT" else None,
-    )
-    return url
+    sign = functools.partial(signed_url, object_name, method, content_type, SIGNED_URL_TTL)
+    url = await asyncio.get_running_loop().run_in_executor(_sign_pool, sign)
+    if len(_SIGNED_URL_CACHE) >= _SIGNED_URL_CACHE_MAX:
+        _SIGNED_URL_CACHE.pop(next(iter(_SIGNED_URL_CACHE)), None)
+    _SIGNED_URL_CACHE[key] = (url, now + SIGNED_URL_TTL)
+    return url, SIGNED_URL_TTL
 
 
 @app.post("/api/upload/signed-url", response_model=SignedUrlResponse, dependencies=[Depends(_auth_guard)])
-def signed_url_endpoint(req: SignedUrlRequest):
+@limiter.limit(settings.signed_url_rate_limit)
+async def signed_url_endpoint(request: Request, req: SignedUrlRequest):
     object_name = f"leads/{req.lead_id}/{req.kind}/{req.filename}"
     method = "PUT" if req.mode == "upload" else "GET"
-    url = _signed_url(object_name=object_name, method=method, content_type=req.content_type)
-    return SignedUrlResponse(url=url, method=method, expires_in=15*60, object_name=object_name)
+    url, expires_in = await _cached_signed_url(object_name, method, req.content_type)
+    return SignedUrlResponse(url=url, method=method, expires_in=expires_in, object_name=object_name)
 
@@ -1,7 +1,8 @@
 from __future__ import annotations
 
 from datetime import datetime
-from sqlalchemy import Column, DateTime, Integer, String, Text, Boolean, ForeignKey
+from sqlalchemy import JSON, Column, DateTime, Integer, String, Text, Boolean, ForeignKey, Index
+from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import declarative_base, relationship
 
 
@@ -25,6 +26,11 @@ class Lead(Base):
     documents = relationship("Document", back_populates="lead")
     signatures = relationship("Signature", back_populates="lead")
 
+    __table_args__ = (
+        Index("ix_leads_city_status", "city", "status"),
+        Index("ix_leads_created_at", "created_at"),
+    )
+
 
 class Document(Base):
     __tablename__ = "documents"
@@ -61,5 +67,9 @@ class Event(Base):
     actor = Column(String(80), default="system")  # system|user|agent
     kind = Column(String(80))
     lead_id = Column(Integer, index=True)
-    payload = Column(Text)
+    payload = Column(JSON().with_variant(JSONB(), "postgresql"))
+
+    __table_args__ = (
+        Index("ix_events_payload_gin", "payload", postgresql_using="gin"),
+    )
 
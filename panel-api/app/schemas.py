@@ -1,6 +1,6 @@
 from __future__ import annotations
 
-from pydantic import BaseModel, Field
+from pydantic import BaseModel, ConfigDict, Field
 from typing import Optional, List
 
 
@@ -13,6 +13,8 @@ class LeadUpsertRequest(BaseModel):
 
 
 class LeadResponse(BaseModel):
+    model_config = ConfigDict(from_attributes=True)
+
     id: int
     phone: str
     name: Optional[str] = None
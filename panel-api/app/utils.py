@@ -1,9 +1,7 @@
 from __future__ import annotations
 
-import base64
-import os
+import secrets
 
 
 def gen_token(nbytes: int = 24) -> str:
-    return base64.urlsafe_b64encode(os.urandom(nbytes)).decode().rstrip("=")
-
+    return secrets.token_urlsafe(nbytes)
@@ -2,16 +2,25 @@
 
 from __future__ import annotations
 
+import asyncio
+import atexit
+import contextvars
 import csv
+import functools
+import hashlib
 import io
-import json
+import logging
 import os
+import threading
+import time
 import unicodedata
-import urllib.request
-from typing import Dict, List, Optional
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List, Optional, Tuple
 
+import httpx
+import orjson
 from google.adk.agents import Agent
-from .config import AGENT_MODEL
+from .config import AGENT_MODEL, SHEET_ID
 import google.generativeai as genai
 
 try:
@@ -24,6 +33,15 @@ try:
 except ImportError:
     RedisMemory = None
 
+try:
+    import pyarrow as pa
+    import pyarrow.compute as pc
+    import pyarrow.csv as pcsv
+except ImportError:
+    pa = None
+
+logger = logging.getLogger(__name__)
+
 DATA_DIR = os.path.join(os.path.dirname(__file__), "data")
 
 _USE_VERTEX = os.environ.get("GOOGLE_GENAI_USE_VERTEXAI", "FALSE").strip().upper() == "TRUE"
@@ -35,77 +53,165 @@ try:
         if genai2 and hasattr(genai2, "configure"):
             genai2.configure(api_key=_API_KEY)
 except Exception as _cfg_exc:
-    print(f"genai configure error: {_cfg_exc}")
+    logger.warning("genai configure error: %s", _cfg_exc)
 
-SHEET_ID = "1DESD3YZwOX0vwbelz5vJ6QJybuhPnjUMLhTlYblQt_c"
 VAGAS_GID = "0"
 CSV_URL = f"https://docs.google.com/spreadsheets/d/{SHEET_ID}/export?format=csv&gid={VAGAS_GID}"
+CSV_TIMEOUT_SEC = float(os.environ.get("VAGAS_CSV_TIMEOUT_SEC", "5"))
+
+# Cliente HTTP compartilhado: mantém a conexão TLS com o Google aberta entre
+# downloads. O export responde com redirect para googleusercontent.com.
+_HTTP = httpx.Client(timeout=CSV_TIMEOUT_SEC, follow_redirects=True)
+atexit.register(_HTTP.close)
+
+# Cache em memória da planilha: as ferramentas são chamadas várias vezes por
+# conversa e a aba muda pouco, então evitamos um download a cada chamada.
+# Guardamos apenas o índice já normalizado (cidades abertas e vagas agrupadas
+# por cidade), montado uma única vez a cada atualização.
+_CSV_TTL_SEC = float(os.environ.get("VAGAS_CSV_TTL_SEC", "60"))
+_CSV_CACHE: Dict[str, object] = {"ts": 0.0, "index": None}
+_CSV_LOCK = threading.Lock()
+
+def _vaga_aberta(status: Optional[str], vagas_restantes: Optional[str]) -> bool:
+    """STATUS = 'Aberto' e VAGAS_RESTANTES >= 1 (vazio/inválido conta como aberta)."""
+    if (status or "").strip().lower() != "aberto":
+        return False
+    try:
+        return vagas_restantes is None or float(vagas_restantes) >= 1
+    except (ValueError, TypeError):
+        return True
+
+def _build_vagas_index(header: List[str], rows: List[List[str]]) -> Dict[str, object]:
+    """Agrupa as vagas abertas por cidade (chave minúscula) em uma única passada.
+
+    As colunas são localizadas uma vez pelo cabeçalho; as linhas ficam como listas.
+    """
+    def col(name: str) -> Optional[int]:
+        return header.index(name) if name in header else None
+
+    i_status, i_restantes, i_cidade = col("STATUS"), col("VAGAS_RESTANTES"), col("CIDADE")
+    i_turno, i_id, i_farmacia, i_taxa = col("TURNO"), col("VAGA_ID"), col("FARMACIA"), col("TAXA_ENTREGA")
+    width = len(header)
+
+    by_city: Dict[str, List[Dict[str, object]]] = {}
+    cidades: set[str] = set()
+    for row in rows:
+        if len(row) < width:
+            row = row + [None] * (width - len(row))
+        if i_status is None or not _vaga_aberta(row[i_status], None if i_restantes is None else row[i_restantes]):
+            continue
+        cidade = (row[i_cidade] or "").strip() if i_cidade is not None else ""
+        if not cidade:
+            continue
+        cidades.add(cidade)
+        by_city.setdefault(cidade.lower(), []).append({
+            "turno": (row[i_turno] or "").strip() if i_turno is not None else "",
+            "vagas_restantes": None if i_restantes is None else row[i_restantes],
+            "vaga_id": None if i_id is None else row[i_id],
+            "farmacia": None if i_farmacia is None else row[i_farmacia],
+            "taxa_entrega": None if i_taxa is None else row[i_taxa],
+        })
+    open_cities = sorted(cidades)
+    # Nome em minúsculas e slug (sem acentos) -> chave de by_city: "sao paulo" acha "São Paulo".
+    resolver = {key: key for key in by_city}
+    for key in by_city:
+        resolver.setdefault(_slugify(key), key)
+    # ETag estável da lista de cidades: quem já tem a lista pode pular o reprocessamento.
+    etag = hashlib.blake2b(",".join(open_cities).encode(), digest_size=8).hexdigest()
+    return {"by_city": by_city, "open_cities": open_cities, "etag": etag, "resolver": resolver}
+
+def _parse_vagas_arrow(content: bytes) -> Tuple[List[str], List[List[str]]]:
+    """Parse em C com pyarrow, descartando de forma vetorizada as linhas sem STATUS 'Aberto'.
 
-def _fetch_vagas_csv() -> List[Dict[str, str]]:
-    """Baixa e parseia a aba 'Vagas' como lista de dicionários."""
-    with urllib.request.urlopen(CSV_URL) as response:
-        csv_data = response.read().decode("utf-8")
-    reader = csv.DictReader(io.StringIO(csv_data))
-    return list(reader)
+    Todas as colunas são lidas como texto para manter os mesmos valores do ``csv``;
+    o filtro completo (incluindo VAGAS_RESTANTES) continua em ``_build_vagas_index``.
+    """
+    header = next(csv.reader(io.StringIO(content.split(b"\n", 1)[0].decode("utf-8"))), [])
+    table = pcsv.read_csv(
+        pa.py_buffer(content),
+        convert_options=pcsv.ConvertOptions(column_types={name: pa.string() for name in header}),
+    )
+    if "STATUS" in header:
+        status = pc.utf8_lower(pc.utf8_trim_whitespace(table["STATUS"]))
+        table = table.filter(pc.fill_null(pc.equal(status, "aberto"), False))
+    columns = [table.column(i).to_pylist() for i in range(table.num_columns)]
+    return header, [list(row) for row in zip(*columns)]
+
+def _parse_vagas_csv(content: bytes) -> Tuple[List[str], List[List[str]]]:
+    """Parseia o CSV exportado; usa pyarrow quando instalado (planilhas grandes)."""
+    if pa is not None:
+        try:
+            return _parse_vagas_arrow(content)
+        except (pa.ArrowInvalid, KeyError) as exc:
+            # Linhas com número irregular de colunas, cabeçalho duplicado etc.
+            logger.info("pyarrow csv fallback: %s", exc)
+    reader = csv.reader(io.StringIO(content.decode("utf-8")))
+    header = next(reader, [])
+    return header, list(reader)
+
+def _fetch_vagas_csv() -> Tuple[List[str], List[List[str]]]:
+    """Baixa e parseia a aba 'Vagas', retornando (cabeçalho, linhas)."""
+    response = _HTTP.get(CSV_URL)
+    response.raise_for_status()
+    return _parse_vagas_csv(response.content)
+
+def _load_vagas_cache() -> Dict[str, object]:
+    """Retorna o cache da planilha, baixando e indexando novamente se expirado."""
+    if _CSV_CACHE["index"] is not None and time.monotonic() - _CSV_CACHE["ts"] < _CSV_TTL_SEC:
+        return _CSV_CACHE
+    with _CSV_LOCK:
+        # Outra thread pode ter atualizado o cache enquanto aguardávamos o lock.
+        if _CSV_CACHE["index"] is not None and time.monotonic() - _CSV_CACHE["ts"] < _CSV_TTL_SEC:
+            return _CSV_CACHE
+        header, rows = _fetch_vagas_csv()
+        _CSV_CACHE.update({"ts": time.monotonic(), "index": _build_vagas_index(header, rows)})
+        return _CSV_CACHE
+
+def _get_vagas_index() -> Dict[str, object]:
+    """Índice das vagas abertas (ver ``_build_vagas_index``), com TTL de ``_CSV_TTL_SEC``."""
+    return _load_vagas_cache()["index"]
+
+def _ascii_fold(text: str) -> str:
+    return unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode()
+
+# Tabela pré-computada (Latin-1 + Latin Extended-A/B) para o caso comum de nomes
+# em português; caracteres fora dela caem no caminho com unicodedata.
+# O espaço vira hífen também quando vem da decomposição (NBSP, "¨", "´" -> " ...").
+_SLUG_TABLE = {cp: _ascii_fold(chr(cp)).replace(" ", "-") for cp in range(0x80, 0x250)}
+_SLUG_TABLE[ord(" ")] = "-"
+
+@functools.lru_cache(maxsize=256)
+def _slugify_slow(text: str) -> str:
+    return _ascii_fold(text).lower().replace(" ", "-")
 
 def _slugify(text: str) -> str:
     """Normaliza uma string para slug (acentos -> ASCII, espaços -> hífens)."""
-    normalized = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode()
-    return normalized.lower().replace(" ", "-")
+    slug = text.translate(_SLUG_TABLE)
+    if slug.isascii():
+        return slug.lower()
+    return _slugify_slow(text)
 
 def listar_cidades_com_vagas() -> Dict[str, object]:
-    """Retorna cidades com vagas abertas (STATUS = 'Aberto' e VAGAS_RESTANTES >= 1)."""
+    """Retorna cidades com vagas abertas (STATUS = 'Aberto' e VAGAS_RESTANTES >= 1).
+
+    Inclui ``etag``, que só muda quando a lista de cidades muda.
+    """
     try:
-        rows = _fetch_vagas_csv()
-        cidades: set[str] = set()
-        for row in rows:
-            status = row.get("STATUS", "").strip().lower()
-            vagas_restantes = row.get("VAGAS_RESTANTES")
-            if status == "aberto":
-                try:
-                    if vagas_restantes is None or float(vagas_restantes) >= 1:
-                        cidade = row.get("CIDADE", "").strip()
-                        if cidade:
-                            cidades.add(cidade)
-                except (ValueError, TypeError):
-                    cidade = row.get("CIDADE", "").strip()
-                    if cidade:
-                        cidades.add(cidade)
-        return {"status": "success", "cidades": sorted(cidades)}
+        index = _get_vagas_index()
+        return {"status": "success", "cidades": list(index["open_cities"]), "etag": index["etag"]}
     except Exception as exc:
         return {"status": "error", "error_message": str(exc)}
 
 def verificar_vagas(cidade: str) -> Dict[str, object]:
     """Retorna os turnos e detalhes das vagas abertas para a cidade informada."""
     try:
-        rows = _fetch_vagas_csv()
-        resultados: List[Dict[str, object]] = []
-        for row in rows:
-            if (
-                row.get("CIDADE", "").strip().lower() == cidade.lower()
-                and row.get("STATUS", "").strip().lower() == "aberto"
-            ):
-                vagas_restantes = row.get("VAGAS_RESTANTES")
-                try:
-                    if vagas_restantes is None or float(vagas_restantes) >= 1:
-                        resultados.append({
-                            "turno": row.get("TURNO", "").strip(),
-                            "vagas_restantes": row.get("VAGAS_RESTANTES"),
-                            "vaga_id": row.get("VAGA_ID"),
-                            "farmacia": row.get("FARMACIA"),
-                            "taxa_entrega": row.get("TAXA_ENTREGA"),
-                        })
-                except (ValueError, TypeError):
-                    resultados.append({
-                        "turno": row.get("TURNO", "").strip(),
-                        "vagas_restantes": row.get("VAGAS_RESTANTES"),
-                        "vaga_id": row.get("VAGA_ID"),
-                        "farmacia": row.get("FARMACIA"),
-                        "taxa_entrega": row.get("TAXA_ENTREGA"),
-                    })
+        index = _get_vagas_index()
+        nome = cidade.strip().lower()
+        key = index["resolver"].get(nome) or index["resolver"].get(_slugify(nome))
+        resultados = index["by_city"].get(key) if key else None
         if not resultados:
             return {"status": "error", "error_message": f"Nenhuma vaga encontrada para {cidade}."}
-        return {"status": "success", "vagas": resultados}
+        return {"status": "success", "vagas": list(resultados)}
     except Exception as exc:
         return {"status": "error", "error_message": str(exc)}
 
@@ -124,9 +230,9 @@ def registrar_interesse_pipeline(candidato: Dict[str, object]) -> Dict[str, obje
     """Registra os dados do candidato em um arquivo JSON Lines."""
     try:
         log_path = os.path.join(DATA_DIR, "interest_log.jsonl")
-        with open(log_path, "a", encoding="utf-8") as f:
-            json.dump(candidato, f, ensure_ascii=False)
-            f.write("\n")
+        # orjson já gera UTF-8; uma única escrita por linha.
+        with open(log_path, "ab") as f:
+            f.write(orjson.dumps(candidato) + b"\n")
         return {"status": "success", "message": "Interesse registrado."}
     except Exception as exc:
         return {"status": "error", "error_message": str(exc)}
@@ -140,16 +246,36 @@ def enviar_link_pipefy(cidade: str) -> Dict[str, object]:
     except Exception as exc:
         return {"status": "error", "error_message": str(exc)}
 
+# Pool próprio das ferramentas do agente: turnos lentos não ocupam o executor padrão do loop.
+_TOOL_POOL = ThreadPoolExecutor(
+    max_workers=int(os.environ.get("RUNNER_POOL", "8")), thread_name_prefix="agent-tool"
+)
+atexit.register(_TOOL_POOL.shutdown, wait=False)
+
+def _tool_em_thread(func):
+    """Expõe uma ferramenta síncrona de I/O como corrotina com o mesmo nome/assinatura.
+
+    O ADK aguarda ferramentas assíncronas, então chamadas feitas no mesmo turno
+    sobrepõem rede/disco em vez de bloquear o event loop uma após a outra.
+    As versões síncronas continuam disponíveis para o webhook do WhatsApp.
+    """
+    @functools.wraps(func)
+    async def wrapper(*args, **kwargs):
+        # Como asyncio.to_thread, mas no _TOOL_POOL e preservando os contextvars.
+        call = functools.partial(contextvars.copy_context().run, func, *args, **kwargs)
+        return await asyncio.get_running_loop().run_in_executor(_TOOL_POOL, call)
+    return wrapper
+
 root_agent = Agent(
     name="rh_kelly_agent",
     model=AGENT_MODEL,
     description="Agente de recrutamento da cooperativa de entregadores RH Kelly.",
     instruction="",
     tools=[
-        listar_cidades_com_vagas,
-        verificar_vagas,
+        _tool_em_thread(listar_cidades_com_vagas),
+        _tool_em_thread(verificar_vagas),
         aplicar_disc,
-        registrar_interesse_pipeline,
+        _tool_em_thread(registrar_interesse_pipeline),
         enviar_link_pipefy,
     ],
 )
@@ -182,4 +308,4 @@ if redis_url and RedisMemory is not None:
     try:
         root_agent.memory_backend = RedisMemory(url=redis_url)
     except Exception as _mem_exc:
-        print(f"RedisMemory init error: {_mem_exc}")
\ No newline at end of file
+        logger.warning("RedisMemory init error: %s", _mem_exc)
\ No newline at end of file
@@ -1,3 +1,6 @@
 import os
 
 AGENT_MODEL = os.environ.get("AGENT_MODEL", "gemini-1.5-flash")
+# Planilha com as abas de vagas e de leads. Este módulo só usa a stdlib: scripts
+# avulsos o carregam sem importar o pacote (que monta o agente no __init__).
+SHEET_ID = os.environ.get("SHEET_ID", "1DESD3YZwOX0vwbelz5vJ6QJybuhPnjUMLhTlYblQt_c")
@@ -0,0 +1,68 @@
+"""
+Corrige na aba de leads os valores antigos de PERFIL_APROVADO gravados como "N�o".
+
+Até a correção em ``services/whatsapp.py`` os leads reprovados eram gravados com o
+caractere de substituição (U+FFFD) no lugar do "ã". Este script localiza essas
+células e as regrava como "Não" numa única chamada ``batch_update``.
+
+Uso (mesmas variáveis de ambiente do serviço):
+
+    python -m scripts.backfill_perfil_aprovado --dry-run
+    python -m scripts.backfill_perfil_aprovado
+"""
+
+import argparse
+import importlib.util
+import os
+from pathlib import Path
+
+import gspread
+import orjson
+from gspread.utils import rowcol_to_a1
+
+
+def _load_config():
+    """Carrega só ``rh_kelly_agent/config.py``: importar o pacote montaria o agente (ADK, Gemini)."""
+    path = Path(__file__).resolve().parent.parent / "rh_kelly_agent" / "config.py"
+    spec = importlib.util.spec_from_file_location("rh_kelly_agent_config", path)
+    module = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    return module
+
+
+SHEET_ID = _load_config().SHEET_ID
+
+_COLUMN = "PERFIL_APROVADO"
+_BROKEN = "N�o"
+_FIXED = "Não"
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--dry-run", action="store_true", help="só conta as células, sem gravar")
+    args = parser.parse_args()
+
+    creds = os.environ.get("GSHEETS_SERVICE_ACCOUNT_JSON")
+    if not creds:
+        raise SystemExit("GSHEETS_SERVICE_ACCOUNT_JSON não definido")
+    title = os.environ.get("LEADS_SHEET_TITLE", "Leads")
+    ws = gspread.service_account_from_dict(orjson.loads(creds)).open_by_key(SHEET_ID).worksheet(title)
+
+    header = ws.row_values(1)
+    if _COLUMN not in header:
+        raise SystemExit(f"coluna {_COLUMN} não encontrada na aba {title!r}")
+    col = header.index(_COLUMN) + 1
+    # col_values começa na linha 1 (cabeçalho).
+    rows = [i for i, value in enumerate(ws.col_values(col), start=1) if i > 1 and value == _BROKEN]
+    print(f"{len(rows)} célula(s) com {_BROKEN!r} em {title}!{_COLUMN}")
+    if args.dry_run or not rows:
+        return
+    ws.batch_update(
+        [{"range": rowcol_to_a1(row, col), "values": [[_FIXED]]} for row in rows],
+        value_input_option="USER_ENTERED",
+    )
+    print(f"{len(rows)} célula(s) corrigida(s) para {_FIXED!r}")
+
+
+if __name__ == "__main__":
+    main()
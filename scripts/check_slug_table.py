@@ -0,0 +1,37 @@
+"""
+Confere que o atalho ``_SLUG_TABLE`` de ``rh_kelly_agent.agent`` gera o mesmo slug
+que o caminho original com unicodedata (NFKD -> ASCII, minúsculas, espaço -> hífen).
+
+O slug vai direto no link do Pipefy; rode após mexer na tabela ou em ``_ascii_fold``:
+
+    python -m scripts.check_slug_table
+"""
+
+import random
+import unicodedata
+
+from rh_kelly_agent.agent import _slugify
+
+# Pontos cobertos pela tabela mais alguns que forçam o caminho lento (combinantes, CJK).
+_CODEPOINTS = list(range(0x250)) + [0x301, 0x303, 0x327, 0x2013, 0x3000]
+
+
+def _slugify_baseline(text: str) -> str:
+    normalized = unicodedata.normalize("NFKD", text).encode("ascii", "ignore").decode()
+    return normalized.lower().replace(" ", "-")
+
+
+def main() -> None:
+    bad = [cp for cp in range(0x250) if _slugify(chr(cp)) != _slugify_baseline(chr(cp))]
+    rng = random.Random(0)
+    for _ in range(20000):
+        text = "".join(chr(rng.choice(_CODEPOINTS)) for _ in range(rng.randint(1, 8)))
+        if _slugify(text) != _slugify_baseline(text):
+            bad.append(text)
+    if bad:
+        raise SystemExit(f"_slugify diverge do caminho unicodedata em {len(bad)} caso(s): {bad[:10]!r}")
+    print("_SLUG_TABLE ok")
+
+
+if __name__ == "__main__":
+    main()
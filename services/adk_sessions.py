@@ -0,0 +1,83 @@
+"""
+Sessões do ADK persistidas no Redis.
+
+O ``InMemorySessionService`` vive dentro de um processo: com vários workers
+(uvicorn/gunicorn ``--workers N``) cada webhook pode cair num worker diferente e o
+usuário perderia o histórico da conversa com o agente. Aqui os eventos de cada
+sessão são anexados a uma lista ``adk:sess:{user_id}:{session_id}`` e a sessão é
+reconstruída (replay dos eventos) no worker que ainda não a tem ou que está
+desatualizado. A cópia em memória continua servindo de cache quente.
+"""
+
+import logging
+from typing import Any, Optional
+
+from google.adk.events import Event
+from google.adk.sessions import InMemorySessionService, Session
+
+logger = logging.getLogger(__name__)
+
+
+class RedisSessionService(InMemorySessionService):
+    """``InMemorySessionService`` com os eventos espelhados numa lista do Redis."""
+
+    def __init__(self, client: Any, ttl_sec: int):
+        super().__init__()
+        self._r = client
+        self._ttl_sec = ttl_sec
+
+    @staticmethod
+    def _key(user_id: str, session_id: str) -> str:
+        return f"adk:sess:{user_id}:{session_id}"
+
+    async def get_session(
+        self,
+        *,
+        app_name: str,
+        user_id: str,
+        session_id: str,
+        config: Optional[Any] = None,
+    ) -> Optional[Session]:
+        session = await super().get_session(app_name=app_name, user_id=user_id, session_id=session_id)
+        key = self._key(user_id, session_id)
+        try:
+            count = await self._r.llen(key)
+            stale = bool(count) and (session is None or len(session.events) != count)
+            raw_events = await self._r.lrange(key, 0, -1) if stale else []
+        except Exception as exc:
+            logger.warning("redis adk session get error: %s", exc)
+            stale = False
+
+        if stale:
+            # Sessão ausente ou atrás do Redis (outro worker respondeu): refaz a partir dos eventos.
+            if session is not None:
+                await super().delete_session(app_name=app_name, user_id=user_id, session_id=session_id)
+            session = await super().create_session(app_name=app_name, user_id=user_id, session_id=session_id)
+            for raw in raw_events:
+                await super().append_event(session=session, event=Event.model_validate_json(raw))
+        if config is None and not stale:
+            return session
+        return await super().get_session(
+            app_name=app_name, user_id=user_id, session_id=session_id, config=config
+        )
+
+    async def append_event(self, session: Session, event: Event) -> Event:
+        event = await super().append_event(session=session, event=event)
+        if event.partial:
+            return event
+        key = self._key(session.user_id, session.id)
+        try:
+            async with self._r.pipeline(transaction=True) as pipe:
+                pipe.rpush(key, event.model_dump_json(exclude_none=True))
+                pipe.expire(key, self._ttl_sec)
+                await pipe.execute()
+        except Exception as exc:
+            logger.warning("redis adk session append error: %s", exc)
+        return event
+
+    async def delete_session(self, *, app_name: str, user_id: str, session_id: str) -> None:
+        await super().delete_session(app_name=app_name, user_id=user_id, session_id=session_id)
+        try:
+            await self._r.delete(self._key(user_id, session_id))
+        except Exception as exc:
+            logger.warning("redis adk session delete error: %s", exc)
@@ -14,32 +14,78 @@ Para funcionar, defina as seguintes variáveis de ambiente no .env ou no sistema
 - VERIFY_TOKEN: <uma string secreta para a verificação do webhook>
 """
 
+import asyncio
+import atexit
+import functools
+import hmac
+import importlib.resources
+import logging
 import os
+import queue
 import base64
-import requests
-import json
+import re
+import threading
 import time
+import unicodedata
+from collections import OrderedDict, defaultdict
+from dataclasses import dataclass
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener
 from urllib.parse import urlparse
-from fastapi import FastAPI, Request, HTTPException, Header
+
+import anyio
+import httpx
+import orjson
+from fastapi import Depends, FastAPI, Request, HTTPException
+from fastapi.middleware.gzip import GZipMiddleware
 from fastapi.responses import PlainTextResponse, JSONResponse
-from pydantic import BaseModel
+from fastapi.security import HTTPAuthorizationCredentials, HTTPBearer
+from starlette.concurrency import run_in_threadpool
+from pydantic import BaseModel, field_validator
 import google.generativeai as genai
-from typing import List, Dict, Any, Optional
+from types import MappingProxyType
+from typing import Any, Awaitable, Callable, Dict, List, Mapping, Optional, Set, Tuple
 from io import BytesIO
 from google.genai import types as genai_types
 
 try:
-    import redis
+    import redis.asyncio as aioredis
+    from redis.exceptions import ResponseError as RedisResponseError
 except ImportError:
-    redis = None
+    aioredis = None
+    RedisResponseError = Exception
 
 from google.adk.runners import Runner
 from google.adk.sessions import InMemorySessionService
-from contextlib import asynccontextmanager
+from services.adk_sessions import RedisSessionService
+from contextlib import aclosing, asynccontextmanager
 from rh_kelly_agent.agent import root_agent
 from rh_kelly_agent.config import AGENT_MODEL
 from rh_kelly_agent.agent import listar_cidades_com_vagas, verificar_vagas, SHEET_ID
 
+# Logs do app (services.* e rh_kelly_agent.*) passam por uma fila: quem loga só
+# enfileira o registro e uma thread dedicada escreve no stderr, então uma rajada
+# de erros não bloqueia o event loop em I/O. Nível via LOG_LEVEL (padrão INFO).
+logger = logging.getLogger(__name__)
+
+def _setup_logging() -> None:
+    log_queue: "queue.SimpleQueue[logging.LogRecord]" = queue.SimpleQueue()
+    stream = logging.StreamHandler()
+    stream.setFormatter(logging.Formatter("%(levelname)s:\t%(name)s - %(message)s"))
+    listener = QueueListener(log_queue, stream)
+    for name in ("services", "rh_kelly_agent"):
+        app_logger = logging.getLogger(name)
+        if any(isinstance(h, QueueHandler) for h in app_logger.handlers):
+            return
+        app_logger.addHandler(QueueHandler(log_queue))
+        app_logger.setLevel(os.environ.get("LOG_LEVEL", "INFO").upper())
+        app_logger.propagate = False
+    listener.start()
+    # Esvazia a fila na saída do processo.
+    atexit.register(listener.stop)
+
+_setup_logging()
+
 # Helpers
 def _env_true(name: str, default: bool = False) -> bool:
     v = os.environ.get(name)
@@ -47,44 +93,41 @@ def _env_true(name: str, default: bool = False) -> bool:
         return default
     return str(v).strip().lower() in {"1", "true", "yes", "y", "on"}
 
+@functools.lru_cache(maxsize=4096)
 def _strip_accents(text: str) -> str:
-    """Remove acentos para facilitar a normalização de entradas (ex.: 'não' -> 'nao')."""
-    try:
-        import unicodedata
-        t = str(text or "")
-        return unicodedata.normalize("NFKD", t).encode("ascii", "ignore").decode()
-    except Exception:
-        return str(text or "")
+    """Remove acentos para facilitar a normalização de entradas (ex.: 'não' -> 'nao').
 
-# Intro script loading
-_INTRO_SCRIPT: Dict[str, Any] = {}
-_SEEN_MSG_IDS: Dict[str, float] = {}
+    Memoizado: rótulos de botões e respostas curtas se repetem o tempo todo.
+    """
+    return unicodedata.normalize("NFKD", str(text or "")).encode("ascii", "ignore").decode()
+
+# Dedup local (sem Redis): msg_id -> expiração, em ordem de inserção.
+_SEEN_MSG_IDS: "OrderedDict[str, float]" = OrderedDict()
 _SEEN_TTL_SEC = 300.0  # 5 minutos
+_SEEN_MAX = 10_000
 
-def _load_intro_script() -> Dict[str, Any]:
-    """Loads the intro script from a JSON file."""
-    global _INTRO_SCRIPT
-    if not _INTRO_SCRIPT:
-        try:
-            base = os.path.dirname(os.path.dirname(__file__))
-            path = os.path.join(base, "rh_kelly_agent", "data", "roteiro_intro.json")
-            # Tolerate UTF-8 BOM (files saved on Windows PowerShell)
-            with open(path, "r", encoding="utf-8-sig") as f:
-                _INTRO_SCRIPT = json.load(f)
-        except Exception as exc:
-            print(f"load intro script error: {exc}")
-            _INTRO_SCRIPT = {"intro": [], "cta_labels": {}}
-    return _INTRO_SCRIPT
+def _read_intro_script() -> Mapping[str, Any]:
+    """Reads the intro script bundled with the agent package (once, at import)."""
+    try:
+        raw = importlib.resources.files("rh_kelly_agent").joinpath("data/roteiro_intro.json").read_bytes()
+        # Tolerate UTF-8 BOM (files saved on Windows PowerShell)
+        script = orjson.loads(raw.removeprefix(b"\xef\xbb\xbf"))
+    except Exception as exc:
+        logger.warning("load intro script error: %s", exc)
+        script = {"intro": [], "cta_labels": {}}
+    return MappingProxyType(script)
 
-def send_intro_message(destino: str, user_id: str, idx: int, nome: str) -> None:
+# Intro script: read-only, shared by every request.
+_INTRO_SCRIPT = _read_intro_script()
+
+async def send_intro_message_async(destino: str, user_id: str, idx: int, nome: str) -> None:
     """Sends an intro message to the user (debounced)."""
-    script = _load_intro_script()
-    intro_messages = script.get("intro", [])
+    intro_messages = _INTRO_SCRIPT.get("intro", [])
     if not (0 < idx <= len(intro_messages)):
         return
 
     # Debounce apenas para reenvio do MESMO passo (idx) em curto intervalo
-    _ctx0 = _load_ctx(user_id) or {}
+    _ctx0 = await _load_ctx(user_id) or {}
     try:
         last_idx = int(_ctx0.get("intro_last_idx") or 0)
     except Exception:
@@ -104,7 +147,7 @@ def send_intro_message(destino: str, user_id: str, idx: int, nome: str) -> None:
     message = intro_messages[idx - 1]
     text = message.get("text", "").format(nome=first_name)
 
-    cta_labels = script.get("cta_labels", {})
+    cta_labels = _INTRO_SCRIPT.get("cta_labels", {})
     next_label = cta_labels.get("next", "Avançar")
     skip_label = cta_labels.get("skip", "Pular")
 
@@ -115,98 +158,211 @@ def send_intro_message(destino: str, user_id: str, idx: int, nome: str) -> None:
 
     # Envia apenas uma mensagem com texto longo e botão "Avançar" (ou Sim/Não no fim).
     # Remove duplicidade e respeita debounce por passo.
-    send_button_message_pairs(destino, text, buttons)
-    _set_last_menu(user_id, _load_ctx(user_id) or {}, menu_type="buttons", body=text, items=buttons)
-    # Atualiza timestamp de envio para debounce
-    try:
-        _ctx0["intro_last_idx"] = int(idx)
-        _ctx0["intro_last_sent_at"] = _now()
-        _save_ctx(user_id, _ctx0)
-    except Exception:
-        pass
+    await send_button_message_pairs_async(destino, text, buttons)
+    # Último menu + timestamp do debounce numa única escrita de campos.
+    await _set_last_menu(
+        user_id, _ctx0, menu_type="buttons", body=text, items=buttons,
+        intro_last_idx=int(idx), intro_last_sent_at=_now(),
+    )
 
-def _handle_intro_action(destino: str, user_id: str, action: str) -> None:
+async def _handle_intro_action(destino: str, user_id: str, action: str) -> None:
     """Handles the user's action during the intro."""
-    ctx = _load_ctx(user_id)
+    ctx = await _load_ctx(user_id)
     current_idx = ctx.get("intro_idx", 1)
     nome = ctx.get("nome", "candidato(a)")
     if bool(ctx.get("from_intro")):
-        ctx["stage"] = "await_city"
-        _save_ctx(user_id, ctx)
-        _send_city_menu(destino, user_id, ctx=ctx)
+        await _send_city_menu(destino, user_id, ctx=ctx, stage="await_city")
         return
 
     if action == "intro_next":
         next_idx = current_idx + 1
-        script = _load_intro_script()
-        intro_messages = script.get("intro", [])
+        intro_messages = _INTRO_SCRIPT.get("intro", [])
         if next_idx <= len(intro_messages):
-            ctx["intro_idx"] = next_idx
-            ctx["stage"] = f"intro_{next_idx}"
-            _save_ctx(user_id, ctx)
-            send_intro_message(destino, user_id, next_idx, nome)
+            await _save_ctx_fields(user_id, intro_idx=next_idx, stage=f"intro_{next_idx}")
+            await send_intro_message_async(destino, user_id, next_idx, nome)
         else:
-            ctx["stage"] = "await_city"
-            ctx["from_intro"] = True
-            _save_ctx(user_id, ctx)
-            _send_city_menu(destino, user_id, ctx=ctx)
+            await _send_city_menu(destino, user_id, ctx=ctx, stage="await_city", from_intro=True)
 
     elif action == "intro_skip":
-        ctx["stage"] = "req_moto"
-        _save_ctx(user_id, ctx)
-        try:
-            send_text_message(destino, "Perfeito! Antes de seguir, preciso confirmar alguns requisitos rapidos.")
-        except Exception:
-            pass
-        _send_requirement_question(destino, "req_moto", user_id=user_id)
-
-def _get_auth_headers() -> Dict[str, str]:
-    """Obtém os cabeçalhos de autenticação para a API do WhatsApp."""
-    token = os.environ.get("WHATSAPP_ACCESS_TOKEN")
-    return {
-        "Authorization": f"Bearer {token}",
-        "Content-Type": "application/json"
-    }
+        await _save_ctx_fields(user_id, stage="req_moto")
+        await send_text_message_async(destino, "Perfeito! Antes de seguir, preciso confirmar alguns requisitos rapidos.")
+        await _send_requirement_question(destino, "req_moto", user_id=user_id)
+
+# Cabeçalhos e URL de envio montados uma vez: token e phone id não mudam com o processo rodando.
+_WA_TOKEN = os.environ.get("WHATSAPP_ACCESS_TOKEN")
+_AUTH_HEADERS: Mapping[str, str] = MappingProxyType({
+    "Authorization": f"Bearer {_WA_TOKEN}",
+    "Content-Type": "application/json",
+})
+_WA_PHONE_ID = os.environ.get("WHATSAPP_PHONE_NUMBER_ID")
+_WA_PHONE_DIGITS = bool(_WA_PHONE_ID and _WA_PHONE_ID.isdigit())
+_GRAPH_URL = "https://graph.facebook.com/v19.0"
+_SEND_URL = f"{_GRAPH_URL}/{_WA_PHONE_ID}/messages"
+_MEDIA_AUTH_HEADERS: Mapping[str, str] = MappingProxyType({"Authorization": _AUTH_HEADERS["Authorization"]})
 
 def _parse_first_json(text: Optional[str]) -> Optional[Dict[str, Any]]:
-    if not text:
+    t = (text or "").strip()
+    # Resposta em texto puro (o caso comum): nada a decodificar.
+    if "{" not in t:
         return None
-    t = text.strip()
     # Caminho rápido: objeto JSON completo
-    if t.startswith("{") and t.endswith("}"):
+    if t[0] == "{" and t[-1] == "}":
         try:
-            return json.loads(t)
-        except Exception:
+            return orjson.loads(t)
+        except orjson.JSONDecodeError:
             pass
-    # Fallback: tenta extrair o primeiro objeto JSON dentro do texto
-    try:
-        start = t.find("{")
-        end = t.rfind("}")
-        if start != -1 and end != -1 and end > start:
-            return json.loads(t[start:end+1])
-    except Exception:
-        pass
+    # Fallback: primeiro objeto balanceado dentro do texto, numa só passada (chaves
+    # dentro de strings não contam; um "}" de um trecho posterior não entra no recorte).
+    start = t.find("{")
+    depth = 0
+    in_string = escape = False
+    for i in range(start, len(t)):
+        ch = t[i]
+        if in_string:
+            if escape:
+                escape = False
+            elif ch == "\\":
+                escape = True
+            elif ch == '"':
+                in_string = False
+        elif ch == '"':
+            in_string = True
+        elif ch == "{":
+            depth += 1
+        elif ch == "}":
+            depth -= 1
+            if depth == 0:
+                try:
+                    return orjson.loads(t[start:i + 1])
+                except orjson.JSONDecodeError:
+                    return None
     return None
 
-def send_text_message(destino: str, texto: str) -> None:
-    """Envia uma mensagem de texto simples."""
-    phone_id = os.environ.get("WHATSAPP_PHONE_NUMBER_ID")
-    url = f"https://graph.facebook.com/v19.0/{phone_id}/messages"
-    payload = {
-        "messaging_product": "whatsapp",
-        "to": destino,
-        "type": "text",
-        "text": {"body": texto},
-    }
-    response = requests.post(url, headers=_get_auth_headers(), json=payload)
+# Cliente HTTP compartilhado (pool de conexões + HTTP/2) para a Graph API.
+# Criado sob demanda e fechado no shutdown do app (ver ``lifespan``).
+_HTTPX: Optional[httpx.AsyncClient] = None
+
+def _get_http() -> httpx.AsyncClient:
+    global _HTTPX
+    if _HTTPX is None:
+        # retries= só repete falhas de conexão (antes de enviar o corpo): POST não duplica mensagem.
+        _HTTPX = httpx.AsyncClient(
+            # Conexão que não abre em 3s falha rápido (e entra no retries= abaixo).
+            timeout=httpx.Timeout(10.0, connect=3.0),
+            transport=httpx.AsyncHTTPTransport(
+                http2=True,
+                retries=2,
+                limits=httpx.Limits(max_connections=200, max_keepalive_connections=50),
+            ),
+        )
+    return _HTTPX
+
+# Limite da Cloud API: ~80 mensagens/s por número. Espaça os envios (token bucket
+# sem tarefa de fundo: cada envio reserva o próximo slot) e limita os em voo; um 429
+# (ou 502/503) pausa todos os envios, com backoff exponencial ou o Retry-After da resposta.
+_WA_MAX_INFLIGHT = int(os.environ.get("WA_MAX_INFLIGHT", "60"))
+_WA_MAX_MPS = float(os.environ.get("WA_MAX_MPS", "80"))
+_WA_429_RETRIES = 3
+# 502/503: o pedido normalmente nem chegou à API, então repetir não duplica a mensagem.
+# 500/504 ficam de fora: a mensagem pode já ter saído.
+_WA_RETRY_STATUS = frozenset({429, 502, 503})
+_WA_SEM = asyncio.Semaphore(_WA_MAX_INFLIGHT)
+_WA_NEXT_SLOT = 0.0
+_WA_PAUSE_UNTIL = 0.0
+
+async def _wa_throttle() -> None:
+    global _WA_NEXT_SLOT
+    while True:
+        now = time.monotonic()
+        if _WA_PAUSE_UNTIL > now:
+            await asyncio.sleep(_WA_PAUSE_UNTIL - now)
+            continue
+        slot = max(now, _WA_NEXT_SLOT)
+        _WA_NEXT_SLOT = slot + 1.0 / _WA_MAX_MPS
+        if slot > now:
+            await asyncio.sleep(slot - now)
+        # Um 429 durante a espera invalida o slot reservado: reserva outro após a pausa.
+        if time.monotonic() >= _WA_PAUSE_UNTIL:
+            return
+
+def _wa_backoff(response: httpx.Response, attempt: int) -> None:
+    global _WA_PAUSE_UNTIL
     try:
-        response.raise_for_status()
-    except requests.HTTPError as e:
-        detail = getattr(response, "text", str(e))
-        print(f"WhatsApp send_text_message error: {detail}")
-        raise
+        delay = float(response.headers.get("Retry-After") or 0)
+    except ValueError:
+        delay = 0.0
+    delay = delay or min(0.5 * (2 ** attempt), 8.0)
+    _WA_PAUSE_UNTIL = max(_WA_PAUSE_UNTIL, time.monotonic() + delay)
+    logger.warning("WhatsApp %s: pausando envios por %.1fs", response.status_code, delay)
+
+_WA_ERROR_BODY_MAX = 2048
+
+class WhatsAppError(Exception):
+    """Resposta de erro da API do WhatsApp (status HTTP e corpo)."""
+
+    def __init__(self, status_code: int, body: str):
+        super().__init__(f"WhatsApp API {status_code}: {body}")
+        self.status_code = status_code
+        self.body = body
+
+async def _post_message(payload: Dict[str, Any], label: str) -> None:
+    """Envia ``payload`` para /messages; loga o corpo do erro e levanta ``WhatsAppError``."""
+    # orjson serializa direto para bytes; o Content-Type já vem em _AUTH_HEADERS.
+    content = orjson.dumps(payload)
+    async with _WA_SEM:
+        for attempt in range(_WA_429_RETRIES + 1):
+            await _wa_throttle()
+            response = await _get_http().post(_SEND_URL, headers=_AUTH_HEADERS, content=content)
+            if response.status_code not in _WA_RETRY_STATUS or attempt == _WA_429_RETRIES:
+                break
+            _wa_backoff(response, attempt)
+    if response.is_error:
+        # Só o começo do corpo: uma página HTML de erro do proxy não precisa ser decodificada inteira.
+        body = response.content[:_WA_ERROR_BODY_MAX].decode("utf-8", "replace")
+        logger.error("WhatsApp %s error: %s", label, body)
+        raise WhatsAppError(response.status_code, body)
+
+_WA_ERRORS_MAX = 20
+
+async def _record_wa_error(user_id: str, exc: WhatsAppError) -> None:
+    """Guarda as últimas falhas de envio do usuário em ``wa:errors:{uid}`` para diagnóstico."""
+    if _r is None:
+        return
+    key = f"wa:errors:{user_id}"
+    entry = orjson.dumps({"at": _now(), "status": exc.status_code, "body": exc.body[:500]})
+    try:
+        async with _r.pipeline(transaction=False) as pipe:
+            pipe.lpush(key, entry)
+            pipe.ltrim(key, 0, _WA_ERRORS_MAX - 1)
+            pipe.expire(key, _CTX_TTL_SEC)
+            await pipe.execute()
+    except Exception as rexc:
+        logger.warning("redis wa error log error: %s", rexc)
+
+# Limites da API para títulos de botão e de linha de lista.
+_BUTTON_TITLE_MAX = 20
+_ROW_TITLE_MAX = 24
+_NEWLINES_TO_SPACE = str.maketrans({"\n": " ", "\r": " "})
+
+@functools.lru_cache(maxsize=2048)
+def _sanitize_title(txt: str, limit: int) -> str:
+    """Título em uma linha, sem espaços nas pontas, cortado em ``limit`` caracteres.
+
+    Os rótulos se repetem a cada envio (cidades, Sim/Não, opções DISC), então o
+    cache transforma quase todas as chamadas em uma consulta de dicionário.
+    """
+    return txt.translate(_NEWLINES_TO_SPACE).strip()[:limit]
+
+# Campos fixos dos payloads de /messages; cada envio só acrescenta destino e conteúdo.
+_TEXT_TEMPLATE: Mapping[str, str] = MappingProxyType({"messaging_product": "whatsapp", "type": "text"})
+_INTERACTIVE_TEMPLATE: Mapping[str, str] = MappingProxyType({"messaging_product": "whatsapp", "type": "interactive"})
 
-def send_button_message(destino: str, corpo: str, botoes: List[str]) -> None:
+async def send_text_message_async(destino: str, texto: str) -> None:
+    """Envia uma mensagem de texto simples."""
+    payload = {**_TEXT_TEMPLATE, "to": destino, "text": {"body": texto}}
+    await _post_message(payload, "send_text_message")
+
+async def send_button_message_async(destino: str, corpo: str, botoes: List[str]) -> None:
     """
     Envia uma mensagem interativa do tipo "button".
 
@@ -215,63 +371,37 @@ def send_button_message(destino: str, corpo: str, botoes: List[str]) -> None:
         corpo: texto exibido na mensagem (pergunta).
         botoes: lista de rótulos dos botões a serem exibidos.
     """
-    phone_id = os.environ.get("WHATSAPP_PHONE_NUMBER_ID")
-    url = f"https://graph.facebook.com/v19.0/{phone_id}/messages"
-
-    def _sanitize_button_title(txt: str, idx: int) -> str:
-        t = (txt or "").strip().replace("\n", " ")
-        if not t:
-            t = f"Opção {idx+1}"
-        return t[:20] if len(t) > 20 else t
-
     buttons_payload = []
     for i, label in enumerate(botoes):
         full_id = str(label)
-        title = _sanitize_button_title(full_id, i)
+        title = _sanitize_title(full_id, _BUTTON_TITLE_MAX) or f"Opção {i+1}"
         buttons_payload.append({
             "type": "reply",
             "reply": {"id": full_id, "title": title}
         })
     payload = {
-        "messaging_product": "whatsapp",
+        **_INTERACTIVE_TEMPLATE,
         "to": destino,
-        "type": "interactive",
         "interactive": {
             "type": "button",
             "body": {"text": corpo},
             "action": {"buttons": buttons_payload},
         },
     }
-    response = requests.post(url, headers=_get_auth_headers(), json=payload)
-    try:
-        response.raise_for_status()
-    except requests.HTTPError as e:
-        detail = getattr(response, "text", str(e))
-        print(f"WhatsApp send_button_message error: {detail}")
-        raise
+    await _post_message(payload, "send_button_message")
 
-def send_list_message(destino: str, corpo: str, opcoes: List[str], botao: str = "Ver opções") -> None:
+async def send_list_message_async(destino: str, corpo: str, opcoes: List[str], botao: str = "Ver opções") -> None:
     """Envia uma mensagem interativa do tipo "list" para mais de 3 opções."""
-    phone_id = os.environ.get("WHATSAPP_PHONE_NUMBER_ID")
-    url = f"https://graph.facebook.com/v19.0/{phone_id}/messages"
-
-    def _sanitize_row_title(txt: str, idx: int) -> str:
-        t = (txt or "").strip().replace("\n", " ")
-        if not t:
-            t = f"Opção {idx+1}"
-        return t[:24] if len(t) > 24 else t
-
     rows = []
     for i, opt in enumerate(opcoes):
         full_id = str(opt)
         rows.append({
             "id": full_id,
-            "title": _sanitize_row_title(full_id, i)
+            "title": _sanitize_title(full_id, _ROW_TITLE_MAX) or f"Opção {i+1}"
         })
     payload = {
-        "messaging_product": "whatsapp",
+        **_INTERACTIVE_TEMPLATE,
         "to": destino,
-        "type": "interactive",
         "interactive": {
             "type": "list",
             "body": {"text": corpo},
@@ -283,162 +413,172 @@ def send_list_message(destino: str, corpo: str, opcoes: List[str], botao: str =
             },
         },
     }
-    response = requests.post(url, headers=_get_auth_headers(), json=payload)
-    try:
-        response.raise_for_status()
-    except requests.HTTPError as e:
-        detail = getattr(response, "text", str(e))
-        print(f"WhatsApp send_list_message error: {detail}")
-        raise
+    await _post_message(payload, "send_list_message")
 
-def send_button_message_pairs(destino: str, corpo: str, pairs: List[Any]) -> None:
+async def send_button_message_pairs_async(destino: str, corpo: str, pairs: List[Any]) -> None:
     """Envia botões com id e título separados."""
-    phone_id = os.environ.get("WHATSAPP_PHONE_NUMBER_ID")
-    url = f"https://graph.facebook.com/v19.0/{phone_id}/messages"
-
-    def _sanitize_title(t: str) -> str:
-        s = (t or "").strip().replace("\n", " ")
-        if not s:
-            s = "Opção"
-        return s[:20] if len(s) > 20 else s
-
     buttons_payload = []
     for item in pairs:
         if isinstance(item, dict):
             _id = str(item.get("id"))
-            _title = _sanitize_title(str(item.get("title")))
+            _title = _sanitize_title(str(item.get("title")), _BUTTON_TITLE_MAX) or "Opção"
         else:
             _id = str(item[0])
-            _title = _sanitize_title(str(item[1]))
+            _title = _sanitize_title(str(item[1]), _BUTTON_TITLE_MAX) or "Opção"
         buttons_payload.append({"type": "reply", "reply": {"id": _id, "title": _title}})
     payload = {
-        "messaging_product": "whatsapp",
+        **_INTERACTIVE_TEMPLATE,
         "to": destino,
-        "type": "interactive",
         "interactive": {
             "type": "button",
             "body": {"text": corpo},
             "action": {"buttons": buttons_payload},
         },
     }
-    response = requests.post(url, headers=_get_auth_headers(), json=payload)
-    try:
-        response.raise_for_status()
-    except requests.HTTPError as e:
-        detail = getattr(response, "text", str(e))
-        print(f"WhatsApp send_button_message_pairs error: {detail}")
-        raise
+    await _post_message(payload, "send_button_message_pairs")
 
-def send_list_message_rows(destino: str, corpo: str, rows_in: List[Any], botao: str = "Ver opções") -> None:
+async def send_list_message_rows_async(destino: str, corpo: str, rows_in: List[Any], botao: str = "Ver opções") -> None:
     """Envia lista com rows custom (id, title[, description])."""
-    phone_id = os.environ.get("WHATSAPP_PHONE_NUMBER_ID")
-    url = f"https://graph.facebook.com/v19.0/{phone_id}/messages"
-
-    def _sanitize_row_title(txt: str, idx: int) -> str:
-        t = (txt or "").strip().replace("\n", " ")
-        return t[:24] if len(t) > 24 else t
-
     rows = []
-    for idx, item in enumerate(rows_in):
+    for item in rows_in:
         if isinstance(item, dict):
             _id = str(item.get("id"))
-            _title = _sanitize_row_title(str(item.get("title")), idx)
+            _title = _sanitize_title(str(item.get("title")), _ROW_TITLE_MAX)
             _desc = item.get("description")
         else:
             _id = str(item[0])
-            _title = _sanitize_row_title(str(item[1]), idx)
+            _title = _sanitize_title(str(item[1]), _ROW_TITLE_MAX)
             _desc = item[2] if len(item) > 2 else None
         row = {"id": _id, "title": _title}
         if _desc:
             row["description"] = str(_desc)
         rows.append(row)
     payload = {
-        "messaging_product": "whatsapp",
+        **_INTERACTIVE_TEMPLATE,
         "to": destino,
-        "type": "interactive",
         "interactive": {
             "type": "list",
             "body": {"text": corpo},
             "action": {"button": botao, "sections": [{"rows": rows}]}
         },
     }
-    response = requests.post(url, headers=_get_auth_headers(), json=payload)
-    try:
-        response.raise_for_status()
-    except requests.HTTPError as e:
-        detail = getattr(response, "text", str(e))
-        print(f"WhatsApp send_list_message_rows error: {detail}")
-        raise
+    await _post_message(payload, "send_list_message_rows")
+
+# Opções listadas após ":" até o fim do texto, ou até o fim da frase.
+_OPT_RE_END = re.compile(r":\s*([^\n\r]+)$")
+_OPT_RE_SENT = re.compile(r":\s*([^.!?]+)[.!?]")
+# Trechos com dígitos (horários, valores) não são opções.
+_OPT_RE_DIGIT = re.compile(r"\d")
 
 def _extract_options_from_text(text: Optional[str]) -> List[str]:
     """Heurística simples para extrair opções do texto do agente."""
     if not text:
         return []
     s = text
-    import re
-    m = re.search(r":\s*([^\n\r]+)$", s) or re.search(r":\s*([^.!?]+)[.!?]", s)
+    m = _OPT_RE_END.search(s) or _OPT_RE_SENT.search(s)
     if not m:
         return []
     region = m.group(1)
     region = region.replace(" ou ", ", ").replace(" e ", ", ")
     parts = [p.strip() for p in region.split(",") if p.strip()]
-    parts = [p for p in parts if len(p) >= 2 and not any(ch.isdigit() for ch in p)]
-    seen = set()
-    out: List[str] = []
-    for p in parts:
-        if p not in seen:
-            out.append(p)
-            seen.add(p)
-    return out
+    # dict.fromkeys: remove repetidas mantendo a ordem.
+    return list(dict.fromkeys(p for p in parts if len(p) >= 2 and not _OPT_RE_DIGIT.search(p)))
 
 # ADK Communication
 _runner: Optional[Runner] = None
 _session_service: Optional[InMemorySessionService] = None
 _APP_NAME = "rh_kelly_agent"
 
+_THREAD_TOKENS = int(os.environ.get("FASTAPI_THREAD_TOKENS", "200"))
+_SHUTDOWN_GRACE_SEC = 10.0
+
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     global _runner, _session_service
-    print("FastAPI app startup event: Initializing ADK Runner...")
+    # Pool de threads do AnyIO (padrão 40) usado pelas rotas síncronas e por run_in_threadpool.
+    anyio.to_thread.current_default_thread_limiter().total_tokens = _THREAD_TOKENS
+    logger.info("FastAPI app startup event: Initializing ADK Runner...")
     try:
-        _session_service = InMemorySessionService()
+        # Com Redis, o histórico do agente é compartilhado entre workers/instâncias.
+        _session_service = RedisSessionService(_r, _CTX_TTL_SEC) if _r is not None else InMemorySessionService()
         _runner = Runner(
             app_name=_APP_NAME,
             agent=root_agent,
             session_service=_session_service
         )
-        print("FastAPI app startup event: Agent runner initialized successfully.")
+        logger.info("FastAPI app startup event: Agent runner initialized successfully.")
     except Exception as e:
-        print(f"FATAL: Agent runner initialization failed: {e}")
+        logger.critical("FATAL: Agent runner initialization failed: %s", e, exc_info=True)
+    leads_flusher = None
+    if _GSHEETS_SERVICE_ACCOUNT_JSON:
+        # Autentica e abre a aba de leads já no startup, fora do primeiro lead.
+        try:
+            await run_in_threadpool(lambda: _get_leads_header(_get_leads_ws()))
+        except Exception as gexc:
+            logger.warning("sheets init error: %s", gexc)
+        leads_flusher = asyncio.create_task(_leads_flusher())
     yield
-    print("FastAPI app shutdown event.")
+    logger.info("FastAPI app shutdown event.")
+    # Leads e respostas ainda em andamento terminam antes de fechar os clientes.
+    if _BACKGROUND_TASKS:
+        await asyncio.wait(set(_BACKGROUND_TASKS), timeout=_SHUTDOWN_GRACE_SEC)
+    if leads_flusher is not None:
+        leads_flusher.cancel()
+        await asyncio.wait({leads_flusher})
+        await _flush_leads()
+    if _HTTPX is not None:
+        await _HTTPX.aclose()
+    if _r is not None:
+        await _r.aclose()
+
+def _event_texts(event: Any) -> List[str]:
+    """Textos das partes de um evento do agente ([] para eventos do usuário ou sem conteúdo)."""
+    if getattr(event, "author", "user") == "user":
+        return []
+    content = getattr(event, "content", None)
+    if content is None:
+        return []
+    return [t for t in (getattr(p, "text", None) for p in (getattr(content, "parts", None) or [])) if t]
+
+# user_ids com sessão do agente garantida neste processo: o Runner relê a sessão a cada
+# turno, então get/create só é necessário na primeira mensagem do usuário.
+_KNOWN_SESSIONS: Set[str] = set()
+_KNOWN_SESSIONS_MAX = 50_000
+
+async def _ensure_agent_session(user_id: str) -> None:
+    if user_id in _KNOWN_SESSIONS:
+        return
+    try:
+        sess = await _session_service.get_session(app_name=_APP_NAME, user_id=user_id, session_id=user_id)
+    except Exception:
+        sess = None
+    if not sess:
+        await _session_service.create_session(app_name=_APP_NAME, user_id=user_id, session_id=user_id)
+    if len(_KNOWN_SESSIONS) >= _KNOWN_SESSIONS_MAX:
+        _KNOWN_SESSIONS.clear()
+    _KNOWN_SESSIONS.add(user_id)
 
 async def enviar_mensagem_ao_agente_async(user_id: str, mensagem: str, stage: Optional[str] = None) -> Dict[str, Any]:
     """Versão assíncrona usando Runner.run_async e SessionService async."""
     if not _runner or not _session_service:
         raise HTTPException(status_code=503, detail="Agent runner not initialized")
-    sess = await _session_service.get_session(
-        app_name=_APP_NAME, user_id=user_id, session_id=user_id
-    )
-    if not sess:
-        await _session_service.create_session(
-            app_name=_APP_NAME, user_id=user_id, session_id=user_id
-        )
+    await _ensure_agent_session(user_id)
 
     full_message = str(mensagem or "")
     if stage:
         full_message = f"Contexto atual: {stage}. Mensagem do usuário: {full_message}"
     content = genai_types.Content(parts=[genai_types.Part(text=full_message)])
-    last_text = None
-    async for event in _runner.run_async(user_id=user_id, session_id=user_id, new_message=content):
-        try:
-            if getattr(event, "author", "user") != "user" and getattr(event, "content", None):
-                parts = getattr(event.content, "parts", None) or []
-                texts = [getattr(p, "text", None) for p in parts if getattr(p, "text", None)]
-                if texts:
-                    last_text = "\n".join(texts).strip()
-        except Exception:
-            pass
+    # Vale o texto do último evento do agente que tiver texto; junta só no final.
+    last_texts: List[str] = []
+    try:
+        async for event in _runner.run_async(user_id=user_id, session_id=user_id, new_message=content):
+            texts = _event_texts(event)
+            if texts:
+                last_texts = texts
+    except Exception:
+        _KNOWN_SESSIONS.discard(user_id)
+        raise
+    last_text = "\n".join(last_texts).strip() if last_texts else None
     parsed = _parse_first_json(last_text or "")
     if isinstance(parsed, dict) and ("content" in parsed or "options" in parsed):
         return {
@@ -448,35 +588,138 @@ async def enviar_mensagem_ao_agente_async(user_id: str, mensagem: str, stage: Op
     return {"content": last_text or "", "options": None}
 
 # Deterministic flow support
-_CITIES_CACHE: Dict[str, Any] = {"expires": 0.0, "items": [], "map": {}}
+_CITIES_CACHE: Dict[str, Any] = {"expires": 0.0, "items": [], "map": {}, "etag": None}
 _USER_CTX: Dict[str, Dict[str, Any]] = {}
 _CTX_TTL_SEC = int(os.environ.get("LEAD_TTL_DAYS", "30")) * 24 * 3600
 
 _REDIS_URL = os.environ.get("REDIS_URL")
 _r = None
-if _REDIS_URL and redis is not None:
+if _REDIS_URL and aioredis is not None:
     try:
-        _r = redis.from_url(_REDIS_URL, decode_responses=True)
+        # Cliente asyncio: as chamadas ao Redis não bloqueiam o event loop do webhook.
+        _r = aioredis.from_url(_REDIS_URL, decode_responses=True)
     except Exception as _rexc:
-        print(f"redis init error: {_rexc}")
+        logger.error("redis init error: %s", _rexc)
+
+def _claim_local(msg_id: str) -> bool:
+    now = time.monotonic()
+    # TTL fixo: as entradas expiram na ordem de inserção, então basta podar pelo início.
+    while _SEEN_MSG_IDS and next(iter(_SEEN_MSG_IDS.values())) <= now:
+        _SEEN_MSG_IDS.popitem(last=False)
+    if msg_id in _SEEN_MSG_IDS:
+        return False
+    _SEEN_MSG_IDS[msg_id] = now + _SEEN_TTL_SEC
+    # Rajada maior que o limite dentro do TTL: descarta os mais antigos.
+    if len(_SEEN_MSG_IDS) > _SEEN_MAX:
+        _SEEN_MSG_IDS.popitem(last=False)
+    return True
+
+# Contexto em HASH (um campo JSON por chave): escritas parciais mandam só os
+# campos alterados e handlers concorrentes não sobrescrevem campos uns dos outros.
+def _ctx_key(user_id: str) -> str:
+    return f"lead_ctx:{user_id}"
 
-def _load_ctx(user_id: str) -> Dict[str, Any]:
+def _is_wrongtype(exc: Exception) -> bool:
+    # Chaves antigas ainda guardam o contexto como blob JSON (string).
+    return isinstance(exc, RedisResponseError) and "WRONGTYPE" in str(exc)
+
+def _ctx_from_hash(raw: Mapping[str, str]) -> Dict[str, Any]:
+    return {k: orjson.loads(v) for k, v in raw.items()}
+
+async def _load_ctx(user_id: str) -> Dict[str, Any]:
     if _r is not None:
+        key = _ctx_key(user_id)
         try:
-            raw = _r.get(f"lead_ctx:{user_id}")
+            raw = await _r.hgetall(key)
             if raw:
-                return json.loads(raw)
+                return _ctx_from_hash(raw)
         except Exception as exc:
-            print(f"redis get ctx error: {exc}")
+            if not _is_wrongtype(exc):
+                logger.warning("redis get ctx error: %s", exc)
+            else:
+                try:
+                    raw = await _r.get(key)
+                    if raw:
+                        return orjson.loads(raw)
+                except Exception as exc2:
+                    logger.warning("redis get ctx error: %s", exc2)
     return _USER_CTX.get(user_id, {})
 
-def _save_ctx(user_id: str, ctx: Dict[str, Any]) -> None:
+async def _save_ctx(user_id: str, ctx: Dict[str, Any]) -> None:
+    """Regrava o contexto inteiro (necessário quando campos são removidos)."""
     _USER_CTX[user_id] = ctx
+    if _r is not None:
+        key = _ctx_key(user_id)
+        try:
+            async with _r.pipeline(transaction=True) as pipe:
+                pipe.delete(key)
+                if ctx:
+                    pipe.hset(key, mapping={k: orjson.dumps(v) for k, v in ctx.items()})
+                    pipe.expire(key, _CTX_TTL_SEC)
+                await pipe.execute()
+        except Exception as exc:
+            logger.warning("redis set ctx error: %s", exc)
+
+async def _save_ctx_fields(user_id: str, **fields: Any) -> None:
+    """Grava apenas os campos informados do contexto."""
+    _USER_CTX.setdefault(user_id, {}).update(fields)
+    if _r is not None and fields:
+        key = _ctx_key(user_id)
+        try:
+            async with _r.pipeline(transaction=True) as pipe:
+                pipe.hset(key, mapping={k: orjson.dumps(v) for k, v in fields.items()})
+                pipe.expire(key, _CTX_TTL_SEC)
+                await pipe.execute()
+        except Exception as exc:
+            if not _is_wrongtype(exc):
+                logger.warning("redis set ctx error: %s", exc)
+                return
+            # Blob legado: migra para HASH numa regravação completa.
+            ctx = dict(await _load_ctx(user_id))
+            ctx.update(fields)
+            await _save_ctx(user_id, ctx)
+
+async def _del_ctx_fields(user_id: str, *names: str) -> None:
+    """Remove campos do contexto."""
+    local = _USER_CTX.get(user_id)
+    if local:
+        for name in names:
+            local.pop(name, None)
+    if _r is not None and names:
+        try:
+            await _r.hdel(_ctx_key(user_id), *names)
+        except Exception as exc:
+            if not _is_wrongtype(exc):
+                logger.warning("redis del ctx error: %s", exc)
+                return
+            ctx = {k: v for k, v in (await _load_ctx(user_id)).items() if k not in names}
+            await _save_ctx(user_id, ctx)
+
+async def _claim_and_load_ctx(msg_id: Optional[str], user_id: str) -> Tuple[bool, Dict[str, Any]]:
+    """Marca o webhook como visto (SET NX EX) e lê o contexto num único round-trip ao Redis.
+
+    Retorna (mensagem nova?, contexto). Mensagens sem id são sempre processadas.
+    Sem Redis (ou se ele falhar), usa o registro e o contexto em memória do processo.
+    """
     if _r is not None:
         try:
-            _r.setex(f"lead_ctx:{user_id}", _CTX_TTL_SEC, json.dumps(ctx, ensure_ascii=False))
+            async with _r.pipeline(transaction=False) as pipe:
+                if msg_id:
+                    pipe.set(f"seen_msg:{msg_id}", "1", nx=True, ex=int(_SEEN_TTL_SEC))
+                pipe.hgetall(_ctx_key(user_id))
+                res = await pipe.execute(raise_on_error=False)
+            if msg_id and isinstance(res[0], Exception):
+                raise res[0]
+            claimed = bool(res[0]) if msg_id else True
+            raw = res[-1]
+            if isinstance(raw, Exception):
+                # Ex.: contexto legado em blob JSON; _load_ctx trata.
+                return claimed, await _load_ctx(user_id)
+            return claimed, _ctx_from_hash(raw) if raw else _USER_CTX.get(user_id, {})
         except Exception as exc:
-            print(f"redis set ctx error: {exc}")
+            logger.warning("redis dedup/ctx error: %s", exc)
+    claimed = _claim_local(msg_id) if msg_id else True
+    return claimed, _USER_CTX.get(user_id, {})
 
 def _now() -> float:
     return time.time()
@@ -484,131 +727,199 @@ def _now() -> float:
 MAX_INVALID_PER_STAGE = int(os.environ.get("MAX_INVALID_PER_STAGE", "2"))
 MAX_OFF_CONTEXT = int(os.environ.get("MAX_OFF_CONTEXT", "3"))
 RECAP_AFTER_MINUTES = int(os.environ.get("RECAP_AFTER_MINUTES", "30"))
+INTRO_BEFORE_CITY = _env_true("INTRO_BEFORE_CITY", default=True)
 
-def _set_last_menu(user_id: str, ctx: Dict[str, Any], *, menu_type: str, body: str, items: List[Any], botao: Optional[str] = None) -> None:
-    ctx["last_menu"] = {
+async def _set_last_menu(user_id: str, ctx: Dict[str, Any], *, menu_type: str, body: str, items: List[Any], botao: Optional[str] = None, **fields: Any) -> None:
+    """Registra o último menu enviado (e campos extras) sem regravar o contexto inteiro."""
+    fields["last_menu"] = {
         "type": menu_type,
         "body": body,
         "items": items,
         "button_label": botao,
     }
-    _save_ctx(user_id, ctx)
+    ctx.update(fields)
+    await _save_ctx_fields(user_id, **fields)
 
-def _resend_last_menu(destino: str, ctx: Dict[str, Any]) -> bool:
+async def _resend_last_menu(destino: str, ctx: Dict[str, Any]) -> bool:
     lm = ctx.get("last_menu") or {}
     if not lm:
         return False
     items = lm.get("items") or []
     if lm.get("type") == "buttons":
         try:
-            send_button_message_pairs(destino, lm.get("body") or "Selecione uma opção:", items)
+            await send_button_message_pairs_async(destino, lm.get("body") or "Selecione uma opção:", items)
             return True
         except Exception:
             return False
     if lm.get("type") == "list":
         try:
-            send_list_message_rows(destino, lm.get("body") or "Selecione uma opção:", items, botao=(lm.get("button_label") or "Ver opções"))
+            await send_list_message_rows_async(destino, lm.get("body") or "Selecione uma opção:", items, botao=(lm.get("button_label") or "Ver opções"))
             return True
         except Exception:
             return False
     return False
 
-def _get_cities_cached(ttl_sec: int = 600) -> Dict[str, Any]:
-    """Busca cidades da planilha com cache simples em memória."""
+# Cache de cidades compartilhado entre workers: HASH nome minúsculo -> nome canônico,
+# com o etag da lista numa chave que expira junto com o TTL. Só um worker por vez
+# recarrega a planilha (lock NX); os demais seguem com a cópia anterior.
+_CITIES_KEY = "wa:cities"
+_CITIES_FRESH_KEY = "wa:cities:fresh"
+_CITIES_LOCK_KEY = "wa:cities:lock"
+
+def _set_cities_local(m: Dict[str, str], etag: Optional[str], expires_in: float) -> None:
+    _CITIES_CACHE.update({
+        "expires": _now() + expires_in,
+        "items": sorted(set(m.values())),
+        "map": m,
+        "etag": etag,
+    })
+
+async def _refresh_cities(ttl_sec: int, stale: Optional[Dict[str, str]] = None) -> None:
+    data = await asyncio.to_thread(listar_cidades_com_vagas)
+    if not isinstance(data, dict) or data.get("status") != "success":
+        # Falha na planilha: mantém a última cópia boa (local ou a do Redis) e tenta de
+        # novo em breve; o mapa compartilhado no Redis não é apagado.
+        m = _CITIES_CACHE["map"] or stale
+        if m:
+            _set_cities_local(m, _CITIES_CACHE["etag"], 5.0)
+        return
+    etag = data.get("etag")
+    if etag and etag == _CITIES_CACHE["etag"] and _CITIES_CACHE["items"]:
+        # Lista inalterada: só renova a validade, sem remontar o mapa.
+        m = _CITIES_CACHE["map"]
+        _CITIES_CACHE["expires"] = _now() + float(ttl_sec)
+    else:
+        items = list(map(str, data.get("cidades", []) or []))
+        m = {str(x).strip().lower(): str(x) for x in items}
+        _set_cities_local(m, etag, float(ttl_sec))
+    if _r is not None:
+        async with _r.pipeline(transaction=True) as pipe:
+            pipe.delete(_CITIES_KEY)
+            if m:
+                pipe.hset(_CITIES_KEY, mapping=m)
+            pipe.set(_CITIES_FRESH_KEY, etag or "", ex=int(ttl_sec))
+            await pipe.execute()
+
+async def _get_cities_cached(ttl_sec: int = 600) -> Dict[str, Any]:
+    """Busca cidades da planilha com cache em memória e, havendo Redis, compartilhado entre workers."""
     if _CITIES_CACHE["expires"] > _now() and _CITIES_CACHE["items"]:
         return _CITIES_CACHE
     try:
-        data = listar_cidades_com_vagas()
-        items: List[str] = []
-        if isinstance(data, dict) and data.get("status") == "success":
-            items = list(map(str, data.get("cidades", []) or []))
-        m = {str(x).strip().lower(): str(x) for x in items}
-        _CITIES_CACHE.update({
-            "expires": _now() + float(ttl_sec),
-            "items": items,
-            "map": m,
-        })
+        if _r is not None:
+            async with _r.pipeline(transaction=False) as pipe:
+                pipe.hgetall(_CITIES_KEY)
+                pipe.get(_CITIES_FRESH_KEY)
+                pipe.ttl(_CITIES_FRESH_KEY)
+                m, etag, ttl = await pipe.execute()
+            if m and ttl > 0:
+                _set_cities_local(m, etag, float(ttl))
+                return _CITIES_CACHE
+            if await _r.set(_CITIES_LOCK_KEY, "1", nx=True, ex=30):
+                try:
+                    await _refresh_cities(ttl_sec, stale=m)
+                finally:
+                    await _r.delete(_CITIES_LOCK_KEY)
+                return _CITIES_CACHE
+            if m:
+                # Outro worker está recarregando: usa a cópia anterior e confere de novo em breve.
+                _set_cities_local(m, etag, 5.0)
+                return _CITIES_CACHE
+        await _refresh_cities(ttl_sec)
     except Exception as exc:
-        print(f"cities cache error: {exc}")
+        logger.warning("cities cache error: %s", exc)
     return _CITIES_CACHE
 
-def _match_city(label: str) -> Optional[str]:
-    m = _get_cities_cached().get("map", {})
+async def _match_city(label: str) -> Optional[str]:
+    m = (await _get_cities_cached()).get("map", {})
     return m.get(str(label or "").strip().lower())
 
-def _send_turno_menu(destino: str, cidade: str) -> None:
-    """Envia opções de turno disponíveis na cidade, de forma determinística."""
+# Vagas por cidade: cache curto no Redis (compartilhado entre workers) e uma única
+# consulta à planilha por cidade em andamento neste processo.
+_VAGAS_TTL_SEC = int(os.environ.get("VAGAS_CACHE_TTL_SEC", "60"))
+_VAGAS_LOCKS: Dict[str, asyncio.Lock] = defaultdict(asyncio.Lock)
+
+def _vagas_cache_key(cidade: str) -> str:
+    return f"wa:vagas:{cidade.strip().lower()}"
+
+async def _get_vagas_cached(key: str) -> Optional[Dict[str, Any]]:
+    if _r is None:
+        return None
     try:
-        res = verificar_vagas(cidade)
+        raw = await _r.get(key)
+        return orjson.loads(raw) if raw else None
     except Exception as exc:
-        print(f"verificar_vagas error: {exc}")
-        send_text_message(destino, f"Cidade selecionada: {cidade}. Não foi possível consultar as vagas agora.")
-        return
-    if not isinstance(res, dict) or res.get("status") != "success":
-        send_text_message(destino, f"Cidade selecionada: {cidade}. Não encontrei vagas abertas no momento.")
+        logger.warning("redis get vagas error: %s", exc)
+        return None
+
+async def _verificar_vagas_async(cidade: str) -> Dict[str, Any]:
+    """``verificar_vagas`` fora do event loop, com cache por cidade e consultas coalescidas."""
+    key = _vagas_cache_key(cidade)
+    res = await _get_vagas_cached(key)
+    if res is not None:
+        return res
+    async with _VAGAS_LOCKS[key]:
+        # Quem esperou o lock encontra o resultado que o primeiro acabou de gravar.
+        res = await _get_vagas_cached(key)
+        if res is not None:
+            return res
+        res = await run_in_threadpool(verificar_vagas, cidade)
+        if _r is not None and isinstance(res, dict) and res.get("status") == "success":
+            try:
+                await _r.set(key, orjson.dumps(res), ex=_VAGAS_TTL_SEC)
+            except Exception as exc:
+                logger.warning("redis set vagas error: %s", exc)
+    return res
+
+async def _send_turno_menu(destino: str, cidade: str) -> None:
+    """Envia opções de turno disponíveis na cidade, de forma determinística."""
+    # Mesma cópia por cidade do menu de vagas (falhas de consulta já são logadas lá).
+    vagas, _ = await _vagas_by_city(cidade)
+    if not vagas:
+        await send_text_message_async(destino, f"Cidade selecionada: {cidade}. Não encontrei vagas abertas no momento.")
         return
-    vagas = res.get("vagas") or []
-    seen = set()
-    turnos: List[str] = []
-    for v in vagas:
-        t = str((v or {}).get("turno", "")).strip()
-        if t and t not in seen:
-            seen.add(t)
-            turnos.append(t)
+    turnos = list(dict.fromkeys(t for t in (str((v or {}).get("turno", "")).strip() for v in vagas) if t))
     content = f"Cidade selecionada: {cidade}. Escolha um turno disponível:"
     if not turnos:
-        send_text_message(destino, f"Cidade selecionada: {cidade}. Existem vagas, mas não consegui listar os turnos agora.")
+        await send_text_message_async(destino, f"Cidade selecionada: {cidade}. Existem vagas, mas não consegui listar os turnos agora.")
         return
     if len(turnos) > 3:
-        send_list_message(destino, content, turnos, botao="Ver turnos")
+        await send_list_message_async(destino, content, turnos, botao="Ver turnos")
     else:
-        send_button_message(destino, content, turnos)
+        await send_button_message_async(destino, content, turnos)
 
-def _handle_city_selection(destino: str, user_id: str, selected: str) -> Dict[str, Any]:
-    cidade = _match_city(selected)
+async def _handle_city_selection(destino: str, user_id: str, selected: str, ctx: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    cidade = await _match_city(selected)
     if not cidade:
         return {"handled": False}
-    ctx = {**_load_ctx(user_id)}
-    ctx.update({"cidade": cidade})
-    if "from_intro" in ctx:
-        try:
-            ctx.pop("from_intro", None)
-        except Exception:
-            pass
-    ctx["stage"] = "req_moto"
-    _save_ctx(user_id, ctx)
-    try:
-        send_text_message(destino, "Perfeito! Antes de seguir, preciso confirmar alguns requisitos rápidos.")
-    except Exception:
-        pass
-    _send_requirement_question(destino, "req_moto", user_id=user_id)
+    await send_text_message_async(destino, "Perfeito! Antes de seguir, preciso confirmar alguns requisitos rápidos.")
+    # from_intro=False vai na mesma escrita do menu (antes era um HDEL à parte); só é lido como booleano.
+    await _send_requirement_question(
+        destino, "req_moto", user_id=user_id, ctx=ctx, cidade=cidade, stage="req_moto", from_intro=False,
+    )
     return {"handled": True}
 
 
-def _handle_city_selection_reject(destino: str, user_id: str, selected: str) -> Dict[str, Any]:
-    cidade = _match_city(selected)
+async def _handle_city_selection_reject(destino: str, user_id: str, selected: str) -> Dict[str, Any]:
+    cidade = await _match_city(selected)
     if not cidade:
         return {"handled": False}
-    ctx = {**_load_ctx(user_id)}
-    ctx.update({"cidade": cidade, "aprovado": False})
-    _save_ctx(user_id, ctx)
-    try:
-        send_text_message(destino, f"Obrigado! Cidade registrada: {cidade}. Seus dados foram salvos para futuras oportunidades.")
-    except Exception:
-        pass
-    _save_lead_record(user_id)
-    ctx["stage"] = "final"
-    _save_ctx(user_id, ctx)
+    await send_text_message_async(destino, f"Obrigado! Cidade registrada: {cidade}. Seus dados foram salvos para futuras oportunidades.")
+    await _save_ctx_fields(user_id, cidade=cidade, aprovado=False, stage="final")
+    _save_lead_record_in_background(user_id)
     return {"handled": True}
 
-def _send_city_menu(destino: str, user_id: str, ctx: Optional[Dict[str, Any]] = None, prompt: Optional[str] = None) -> None:
+async def _send_city_menu(destino: str, user_id: str, ctx: Optional[Dict[str, Any]] = None, prompt: Optional[str] = None, **fields: Any) -> None:
+    """Envia o menu de cidades; ``fields`` (ex.: ``stage``) são gravados junto com o último menu."""
     if ctx is None:
-        ctx = _load_ctx(user_id) or {}
+        ctx = await _load_ctx(user_id) or {}
 
-    cache = _get_cities_cached()
+    cache = await _get_cities_cached()
     cities = cache.get("items", []) or []
     if not cities:
-        send_text_message(destino, "No momento, não consegui obter as cidades com vagas.")
+        await send_text_message_async(destino, "No momento, não consegui obter as cidades com vagas.")
+        if fields:
+            ctx.update(fields)
+            await _save_ctx_fields(user_id, **fields)
         return
     nome = ctx.get("nome", "candidato(a)")
     pergunta = prompt or ("Antes de come??armos, preciso saber: \\n" "Em qual cidade vocG atua como entregador?\\n" "Selecione no menu abaixo")
@@ -620,28 +931,35 @@ def _send_city_menu(destino: str, user_id: str, ctx: Optional[Dict[str, Any]] =
     )
     pairs = [(c, c) for c in cities]
     if len(cities) > 3:
-        send_list_message_rows(destino, pergunta, pairs, botao="Ver cidades")
-        _set_last_menu(user_id, ctx, menu_type="list", body=pergunta, items=pairs, botao="Ver cidades")
+        await send_list_message_rows_async(destino, pergunta, pairs, botao="Ver cidades")
+        await _set_last_menu(user_id, ctx, menu_type="list", body=pergunta, items=pairs, botao="Ver cidades", **fields)
     else:
-        send_button_message_pairs(destino, pergunta, pairs)
-        _set_last_menu(user_id, ctx, menu_type="buttons", body=pergunta, items=pairs)
-
-def _send_requirement_question(destino: str, req_key: str, user_id: Optional[str] = None) -> None:
-    body = {
-        "req_moto": "Você possui moto própria com documentação em dia?",
-        "req_cnh": "Você possui CNH categoria A ativa?",
-        "req_android": "Você possui um dispositivo Android para trabalhar?",
-    }.get(req_key, "Confirma?")
-    pairs = [("Sim", "Sim"), ("Não", "Não")]
-    send_button_message_pairs(destino, body, pairs)
+        await send_button_message_pairs_async(destino, pergunta, pairs)
+        await _set_last_menu(user_id, ctx, menu_type="buttons", body=pergunta, items=pairs, **fields)
+
+_YES_NO_PAIRS: Tuple[Tuple[str, str], ...] = (("Sim", "Sim"), ("Não", "Não"))
+_REQ_QUESTIONS: Dict[str, str] = {
+    "req_moto": "Você possui moto própria com documentação em dia?",
+    "req_cnh": "Você possui CNH categoria A ativa?",
+    "req_android": "Você possui um dispositivo Android para trabalhar?",
+}
+
+async def _send_requirement_question(destino: str, req_key: str, user_id: Optional[str] = None, ctx: Optional[Dict[str, Any]] = None, **fields: Any) -> None:
+    body = _REQ_QUESTIONS.get(req_key, "Confirma?")
+    await send_button_message_pairs_async(destino, body, _YES_NO_PAIRS)
     if user_id:
-        _set_last_menu(user_id, _load_ctx(user_id), menu_type="buttons", body=body, items=pairs)
+        if ctx is None:
+            ctx = await _load_ctx(user_id) or {}
+        await _set_last_menu(user_id, ctx, menu_type="buttons", body=body, items=_YES_NO_PAIRS, **fields)
+
+_YES_WORDS = frozenset({"sim", "s", "ok", "claro", "yes"})
+_NO_WORDS = frozenset({"nao", "não", "n", "no"})
 
 def _normalize_yes_no(text: str) -> Optional[bool]:
     t = (text or "").strip().lower()
-    if t in {"sim", "s", "ok", "claro", "yes"}:
+    if t in _YES_WORDS:
         return True
-    if t in {"nao", "não", "n", "no"}:
+    if t in _NO_WORDS:
         return False
     return None
 
@@ -719,14 +1037,19 @@ _DISC_TRAIT_SCORES = {
     "Q5_C": {"S": 1, "C": 1},
 }
 
-def _send_disc_question(destino: str, q_idx: int, user_id: Optional[str] = None, ctx: Optional[Dict[str, Any]] = None) -> None:
-    if user_id and ctx is None:
-        ctx = _load_ctx(user_id) or {}
-    elif ctx is None:
-        ctx = {}
+# Resposta -> (pontos, D, I, S, C): pontuação e traços somados numa única passada.
+_DISC_TRAITS = ("D", "I", "S", "C")
+_DISC_ANSWER_TABLE: Dict[str, Tuple[int, ...]] = {
+    ans_id: (points, *(_DISC_TRAIT_SCORES.get(ans_id, {}).get(t, 0) for t in _DISC_TRAITS))
+    for ans_id, points in _DISC_SCORES.items()
+}
+_DISC_ZERO = (0,) * (1 + len(_DISC_TRAITS))
+
+# Limite do corpo de mensagens interativas (button/list) na Cloud API.
+_INTERACTIVE_BODY_MAX = 1024
 
-    q = _DISC_QUESTIONS[q_idx]
-    
+def _build_disc_payload(q: Dict[str, Any]) -> Tuple[Optional[str], str, Tuple[Tuple[str, str], ...]]:
+    """Monta (texto prévio ou None, corpo dos botões, botões) de uma pergunta DISC."""
     full_text_message = f"Cenário: {q['text']}\n\nComo você agiria?\n"
     button_pairs = []
     for i, (_id, title) in enumerate(q["options"]):
@@ -734,151 +1057,358 @@ def _send_disc_question(destino: str, q_idx: int, user_id: Optional[str] = None,
         full_text_message += f"{option_label}) {title}\n"
         button_pairs.append((_id, f"Opção {option_label}"))
 
-    send_text_message(destino, full_text_message)
-
     body_buttons = "Selecione uma opção abaixo:"
-    send_button_message_pairs(destino, body_buttons, button_pairs)
+    merged = f"{full_text_message}\n{body_buttons}"
+    if len(merged) <= _INTERACTIVE_BODY_MAX:
+        # Cenário + botões numa única mensagem: um round-trip e sem risco de chegarem fora de ordem.
+        return None, merged, tuple(button_pairs)
+    return full_text_message, body_buttons, tuple(button_pairs)
+
+# As perguntas são fixas: payloads montados uma vez na importação.
+_DISC_PAYLOADS = [_build_disc_payload(q) for q in _DISC_QUESTIONS]
+
+async def _send_disc_question(destino: str, q_idx: int, user_id: Optional[str] = None, ctx: Optional[Dict[str, Any]] = None, **fields: Any) -> None:
+    pre_text, body_buttons, button_pairs = _DISC_PAYLOADS[q_idx]
+    if pre_text:
+        await send_text_message_async(destino, pre_text)
+    await send_button_message_pairs_async(destino, body_buttons, button_pairs)
 
     if user_id:
-        _set_last_menu(user_id, ctx, menu_type="buttons", body=body_buttons, items=button_pairs)
+        if ctx is None:
+            ctx = await _load_ctx(user_id) or {}
+        await _set_last_menu(user_id, ctx, menu_type="buttons", body=body_buttons, items=button_pairs, **fields)
 
-def _map_disc_selection(q_idx: int, selected_label: str) -> Optional[str]:
-    q = _DISC_QUESTIONS[q_idx]
-    for _id, _ in q["options"]:
-        if selected_label == _id:
-            return _id
-    return None
+_DISC_OPTION_IDS = [frozenset(_id for _id, _ in q["options"]) for q in _DISC_QUESTIONS]
 
-def _fetch_vagas_by_city(cidade: str) -> List[Dict[str, Any]]:
+def _map_disc_selection(q_idx: int, selected_label: str) -> Optional[str]:
+    return selected_label if selected_label in _DISC_OPTION_IDS[q_idx] else None
+
+# Campos da vaga guardados no contexto; as chaves já vêm normalizadas (minúsculas)
+# do índice da planilha em ``rh_kelly_agent.agent._build_vagas_index``.
+_VAGA_FIELDS = ("vaga_id", "farmacia", "turno", "taxa_entrega")
+
+# Cópia local por cidade (expira com _VAGAS_TTL_SEC): lista para o menu e índice por
+# VAGA_ID (só os _VAGA_FIELDS) para a seleção, sem ir ao Redis/planilha a cada interação.
+_VAGAS_LOCAL_MAX = 64
+_VAGAS_LOCAL: Dict[str, Tuple[float, List[Dict[str, Any]], Dict[str, Dict[str, Any]]]] = {}
+
+async def _vagas_by_city(cidade: str) -> Tuple[List[Dict[str, Any]], Dict[str, Dict[str, Any]]]:
+    key = cidade.strip().lower()
+    now = time.monotonic()
+    hit = _VAGAS_LOCAL.get(key)
+    if hit and hit[0] > now:
+        return hit[1], hit[2]
+    vagas: List[Dict[str, Any]] = []
     try:
-        res = verificar_vagas(cidade)
+        res = await _verificar_vagas_async(cidade)
         if isinstance(res, dict) and res.get("status") == "success":
-            return list(res.get("vagas") or [])
+            vagas = list(res.get("vagas") or [])
     except Exception as exc:
-        print(f"fetch vagas error: {exc}")
-    return []
+        logger.warning("fetch vagas error: %s", exc)
+    # Já projetado nos _VAGA_FIELDS: a seleção grava o dict do índice direto no contexto.
+    by_id: Dict[str, Dict[str, Any]] = {}
+    for v in vagas:
+        by_id.setdefault(str(v.get("vaga_id")), {k: v.get(k) for k in _VAGA_FIELDS})
+    if vagas:
+        if key not in _VAGAS_LOCAL and len(_VAGAS_LOCAL) >= _VAGAS_LOCAL_MAX:
+            _VAGAS_LOCAL.pop(next(iter(_VAGAS_LOCAL)), None)
+        _VAGAS_LOCAL[key] = (now + _VAGAS_TTL_SEC, vagas, by_id)
+    return vagas, by_id
+
+async def _fetch_vagas_by_city(cidade: str) -> List[Dict[str, Any]]:
+    return (await _vagas_by_city(cidade))[0]
 
-def _send_vagas_menu(destino: str, cidade: str, user_id: Optional[str] = None, ctx: Optional[Dict[str, Any]] = None) -> None:
+async def _send_vagas_menu(destino: str, cidade: str, user_id: Optional[str] = None, ctx: Optional[Dict[str, Any]] = None) -> None:
     if user_id and ctx is None:
-        ctx = _load_ctx(user_id) or {}
+        ctx = await _load_ctx(user_id) or {}
     elif ctx is None:
         ctx = {}
 
-    vagas = _fetch_vagas_by_city(cidade)
+    vagas = await _fetch_vagas_by_city(cidade)
     if not vagas:
-        send_text_message(destino, f"Aprovado! Porém, não encontrei vagas listadas agora para {cidade}.")
+        await send_text_message_async(destino, f"Aprovado! Porém, não encontrei vagas listadas agora para {cidade}.")
         return
     rows_labels = []
     for v in vagas:
-        vid = str(v.get("vaga_id") or v.get("VAGA_ID") or "?")
-        farm = str(v.get("farmacia") or v.get("FARMACIA") or "?")
-        turno = str(v.get("turno") or v.get("TURNO") or "?")
-        taxa = str(v.get("taxa_entrega") or v.get("TAXA_ENTREGA") or "?")
+        vid = str(v.get("vaga_id") or "?")
+        farm = str(v.get("farmacia") or "?")
+        turno = str(v.get("turno") or "?")
+        taxa = str(v.get("taxa_entrega") or "?")
         rows_labels.append((vid, f"ID {vid}", f"Turno: {turno} | Farmácia: {farm} | Taxa: {taxa}"))
     body_list = "Selecione uma vaga no menu abaixo 👇"
-    send_list_message_rows(destino, body_list, rows_labels, botao="Ver vagas")
+    await send_list_message_rows_async(destino, body_list, rows_labels, botao="Ver vagas")
     if user_id:
-        _set_last_menu(user_id, ctx, menu_type="list", body=body_list, items=rows_labels, botao="Ver vagas")
+        await _set_last_menu(user_id, ctx, menu_type="list", body=body_list, items=rows_labels, botao="Ver vagas")
 
-def _find_vaga_by_row_title(cidade: str, title_or_id: str) -> Optional[Dict[str, Any]]:
-    vagas = _fetch_vagas_by_city(cidade)
+async def _find_vaga_by_row_title(cidade: str, title_or_id: str) -> Optional[Dict[str, Any]]:
+    _, by_id = await _vagas_by_city(cidade)
     t = (title_or_id or "").strip()
-    vid = t
-    if t.lower().startswith("id "):
-        parts = t.split(" ", 2)
-        if len(parts) >= 2:
-            vid = parts[1]
-    for v in vagas:
-        if str(v.get("vaga_id") or v.get("VAGA_ID")) == vid:
-            return v
-    return None
+    # O id da linha do menu é o VAGA_ID; "ID 12" (título digitado) também vale.
+    vid = t.split(" ", 2)[1] if t[:3].lower() == "id " else t
+    return by_id.get(vid)
+
+# Aba de leads: cliente autenticado, worksheet e cabeçalho reaproveitados entre
+# gravações (cada um custa um round-trip ao Google). O cabeçalho é relido a cada
+# _GS_HEADER_TTL_SEC e tudo é reaberto após uma falha de escrita.
+_GS_WS: Any = None
+_GS_HEADER: Optional[Tuple[str, ...]] = None
+_GS_HEADER_AT = 0.0
+_GS_HEADER_TTL_SEC = float(os.environ.get("LEADS_HEADER_TTL_SEC", "600"))
+_GSHEETS_SERVICE_ACCOUNT_JSON = os.environ.get("GSHEETS_SERVICE_ACCOUNT_JSON")
+_LEADS_SHEET_TITLE = os.environ.get("LEADS_SHEET_TITLE", "Leads")
+_GS_LOCK = threading.Lock()
+
+def _get_leads_ws() -> Any:
+    global _GS_WS
+    if _GS_WS is None:
+        with _GS_LOCK:
+            if _GS_WS is None:
+                import gspread
+                sa = gspread.service_account_from_dict(orjson.loads(_GSHEETS_SERVICE_ACCOUNT_JSON))
+                ws_title = _LEADS_SHEET_TITLE
+                _GS_WS = sa.open_by_key(SHEET_ID).worksheet(ws_title)
+    return _GS_WS
+
+def _get_leads_header(ws: Any) -> Tuple[str, ...]:
+    global _GS_HEADER, _GS_HEADER_AT
+    if _GS_HEADER is None or time.monotonic() - _GS_HEADER_AT > _GS_HEADER_TTL_SEC:
+        _GS_HEADER = tuple(ws.row_values(1))
+        _GS_HEADER_AT = time.monotonic()
+    return _GS_HEADER
+
+def _reset_leads_ws() -> None:
+    global _GS_WS, _GS_HEADER
+    _GS_WS = None
+    _GS_HEADER = None
+
+@dataclass(slots=True)
+class LeadRow:
+    """Registro final do lead: JSON em ``leads_records``/``lead_final`` e linha da aba de leads.
+
+    Campos na mesma ordem do JSON gravado no Redis (o orjson serializa dataclasses direto).
+    """
+    user_id: str
+    nome: Optional[str] = None
+    cidade: Optional[str] = None
+    req_moto: Optional[bool] = None
+    req_cnh: Optional[bool] = None
+    req_android: Optional[bool] = None
+    disc_score: Optional[int] = None
+    aprovado: Optional[bool] = None
+    vaga_id: Optional[str] = None
+    turno: Optional[str] = None
+    farmacia: Optional[str] = None
+    taxa_entrega: Optional[str] = None
+    timestamp: int = 0
+
+    @classmethod
+    def from_ctx(cls, user_id: str, ctx: Dict[str, Any]) -> "LeadRow":
+        vaga = ctx.get("vaga") or {}
+        return cls(
+            user_id=user_id,
+            nome=ctx.get("nome"),
+            cidade=ctx.get("cidade"),
+            req_moto=ctx.get("req_moto"),
+            req_cnh=ctx.get("req_cnh"),
+            req_android=ctx.get("req_android"),
+            disc_score=ctx.get("disc_score"),
+            aprovado=ctx.get("aprovado"),
+            vaga_id=vaga.get("vaga_id"),
+            turno=vaga.get("turno"),
+            farmacia=vaga.get("farmacia"),
+            taxa_entrega=vaga.get("taxa_entrega"),
+            timestamp=int(time.time()),
+        )
+
+# Coluna da aba de leads -> valor a partir de (LeadRow, análise de perfil). Colunas
+# fora da tabela leem o atributo de mesmo nome do LeadRow (ou ficam vazias).
+_LEAD_COLUMNS: Mapping[str, Callable[[LeadRow, Any], Any]] = MappingProxyType({
+    "DATA_ISO": lambda r, a: datetime.fromtimestamp(r.timestamp, timezone.utc).isoformat(),
+    "NOME": lambda r, a: r.nome,
+    "TELEFONE": lambda r, a: r.user_id,
+    "PERFIL_APROVADO": lambda r, a: "Sim" if r.aprovado else "Não",
+    "PERFIL_NOTA": lambda r, a: r.disc_score,
+    "PROTOCOLO": lambda r, a: f"{r.timestamp}-{r.user_id}",
+    "TURNO_ESCOLHIDO": lambda r, a: r.turno,
+    "VAGA_ID": lambda r, a: r.vaga_id,
+    "FARMACIA": lambda r, a: r.farmacia,
+    "CIDADE": lambda r, a: r.cidade,
+    "TAXA_ENTREGA": lambda r, a: r.taxa_entrega,
+    "ANALISE_PERFIL": lambda r, a: a,
+})
+
+@functools.lru_cache(maxsize=8)
+def _lead_row_getters(header: Tuple[str, ...]) -> Tuple[Callable[[LeadRow, Any], Any], ...]:
+    """Compila o cabeçalho (muda raramente) numa tupla de getters, um por coluna."""
+    return tuple(
+        _LEAD_COLUMNS.get(h) or (lambda r, a, h=h: getattr(r, h, None))
+        for h in header
+    )
 
-def _save_lead_record(user_id: str) -> None:
-    ctx = _load_ctx(user_id) or {}
+def _append_leads_to_sheet(batch: List[Tuple[str, LeadRow, Any]]) -> None:
+    """Acrescenta os leads na aba de leads numa única chamada (gspread é síncrono: rodar em thread)."""
+    ws = _get_leads_ws()
     try:
-        row = {
-            "user_id": user_id,
-            "nome": ctx.get("nome"),
-            "cidade": ctx.get("cidade"),
-            "req_moto": ctx.get("req_moto"),
-            "req_cnh": ctx.get("req_cnh"),
-            "req_android": ctx.get("req_android"),
-            "disc_score": ctx.get('disc_score'),
-            "aprovado": ctx.get("aprovado"),
-            "vaga_id": (ctx.get("vaga") or {}).get("VAGA_ID") or (ctx.get("vaga") or {}).get("vaga_id"),
-            "turno": (ctx.get("vaga") or {}).get("TURNO") or (ctx.get("vaga") or {}).get("turno"),
-            "farmacia": (ctx.get("vaga") or {}).get("FARMACIA") or (ctx.get("vaga") or {}).get("farmacia"),
-            "taxa_entrega": (ctx.get("vaga") or {}).get("TAXA_ENTREGA") or (ctx.get("vaga") or {}).get("taxa_entrega"),
-            "timestamp": int(time.time()),
-        }
-        creds_json = os.environ.get("GSHEETS_SERVICE_ACCOUNT_JSON")
-        if creds_json:
-            import gspread
-            import json as _json
-            sa = gspread.service_account_from_dict(_json.loads(creds_json))
-            sh = sa.open_by_key(SHEET_ID)
-            ws_title = os.environ.get("LEADS_SHEET_TITLE", "Leads")
-            ws = sh.worksheet(ws_title)
-            try:
-                header = ws.row_values(1)
-                from datetime import datetime, timezone
-                iso = datetime.now(timezone.utc).isoformat()
-                aprovado = row.get("aprovado")
-                score = row.get("disc_score")
-                protocolo = f"{int(time.time())}-{user_id}"
-                turno = row.get("turno")
-                mapping = {
-                    "DATA_ISO": iso,
-                    "NOME": row.get("nome"),
-                    "TELEFONE": row.get("user_id"),
-                    "PERFIL_APROVADO": "Sim" if aprovado else "N�o",
-                    "PERFIL_NOTA": score,
-                    "PROTOCOLO": protocolo,
-                    "TURNO_ESCOLHIDO": turno,
-                    "VAGA_ID": row.get("vaga_id"),
-                    "FARMACIA": row.get("farmacia"),
-                    "CIDADE": row.get("cidade"),
-                    "TAXA_ENTREGA": row.get("taxa_entrega"),
-                    "ANALISE_PERFIL": ctx.get('analise_perfil'),
-                }
-                values = [mapping.get(h, row.get(h)) for h in header]
-                ws.append_row(values, value_input_option="USER_ENTERED")
-            except Exception as ws_exc:
-                print(f"sheets append error: {ws_exc}")
-        if _r is not None:
-            try:
-                _r.rpush("leads_records", json.dumps(row, ensure_ascii=False))
-                _r.set(f"lead_final:{user_id}", json.dumps(row, ensure_ascii=False))
-            except Exception as rex:
-                print(f"redis save lead error: {rex}")
+        getters = _lead_row_getters(_get_leads_header(ws))
+        ws.append_rows(
+            [[get(row, analise) for get in getters] for _, row, analise in batch],
+            value_input_option="USER_ENTERED",
+        )
+    except Exception:
+        _reset_leads_ws()
+        raise
+
+# Leads aguardando a planilha: a cota do Sheets é por escrita, então acumulamos por
+# alguns segundos (ou até _LEADS_BATCH_MAX) e gravamos com um append_rows. Com Redis a
+# fila é a lista leads:pending: o flusher lê um lote com LRANGE e só remove (LTRIM)
+# depois do append_rows, então um crash ou uma falha da planilha não perde linhas
+# (no pior caso, um lote já gravado é repetido). Sem Redis (ou se o RPUSH falhar) o
+# lote fica só na memória do processo.
+_LEADS_FLUSH_SEC = float(os.environ.get("LEADS_FLUSH_SEC", "3"))
+_LEADS_BATCH_MAX = 50
+_LEADS_BUFFER_MAX = 1000
+_LEAD_BUFFER: List[Tuple[str, LeadRow, Any]] = []
+_LEADS_PENDING_KEY = "leads:pending"
+# Um flusher por vez entre os workers: dois lendo o mesmo lote gravariam linhas duplicadas.
+_LEADS_PENDING_LOCK_KEY = "leads:pending:lock"
+# leads_records guarda só os mais recentes; lead_final expira junto com o contexto.
+_LEADS_RECORDS_MAX = int(os.environ.get("LEADS_RECORDS_MAX", "10000"))
+_LEADS_FLUSH_NOW = asyncio.Event()
+
+def _decode_pending_lead(raw: Any) -> Optional[Tuple[str, LeadRow, Any]]:
+    try:
+        entry = orjson.loads(raw)
+        row = LeadRow(**entry["row"])
+        return row.user_id, row, entry.get("analise")
+    except Exception as exc:
+        logger.warning("leads:pending entrada inválida descartada: %s", exc)
+        return None
+
+async def _flush_pending_leads() -> None:
+    """Grava na planilha os lotes de ``leads:pending``, removendo cada lote só após o sucesso."""
+    try:
+        if not await _r.set(_LEADS_PENDING_LOCK_KEY, "1", nx=True, ex=60):
+            return
+    except Exception as rexc:
+        logger.warning("redis leads lock error: %s", rexc)
+        return
+    try:
+        while True:
+            raw = await _r.lrange(_LEADS_PENDING_KEY, 0, _LEADS_BATCH_MAX - 1)
+            if not raw:
+                return
+            batch = [lead for lead in map(_decode_pending_lead, raw) if lead is not None]
+            if batch:
+                await run_in_threadpool(_append_leads_to_sheet, batch)
+            await _r.ltrim(_LEADS_PENDING_KEY, len(raw), -1)
+            if len(raw) < _LEADS_BATCH_MAX:
+                return
     except Exception as exc:
-        print(f"save lead error: {exc}")
+        # O lote continua em leads:pending; o próximo ciclo tenta de novo.
+        logger.warning("sheets append error: %s", exc)
+    finally:
+        try:
+            await _r.delete(_LEADS_PENDING_LOCK_KEY)
+        except Exception:
+            pass
+
+async def _flush_leads() -> None:
+    global _LEAD_BUFFER
+    if _r is not None:
+        await _flush_pending_leads()
+    if not _LEAD_BUFFER:
+        return
+    batch, _LEAD_BUFFER = _LEAD_BUFFER, []
+    try:
+        await run_in_threadpool(_append_leads_to_sheet, batch)
+    except Exception as ws_exc:
+        logger.warning("sheets append error: %s", ws_exc)
+        # Tenta de novo no próximo ciclo, sem crescer sem limite.
+        _LEAD_BUFFER = (batch + _LEAD_BUFFER)[-_LEADS_BUFFER_MAX:]
+
+async def _leads_flusher() -> None:
+    while True:
+        try:
+            await asyncio.wait_for(_LEADS_FLUSH_NOW.wait(), timeout=_LEADS_FLUSH_SEC)
+        except asyncio.TimeoutError:
+            pass
+        _LEADS_FLUSH_NOW.clear()
+        await _flush_leads()
+
+def _buffer_lead(user_id: str, row: LeadRow, analise: Any) -> None:
+    _LEAD_BUFFER.append((user_id, row, analise))
+    if len(_LEAD_BUFFER) >= _LEADS_BATCH_MAX:
+        _LEADS_FLUSH_NOW.set()
+
+async def _save_lead_record(user_id: str) -> None:
+    ctx = await _load_ctx(user_id) or {}
+    try:
+        row = LeadRow.from_ctx(user_id, ctx)
+        to_sheet = bool(_GSHEETS_SERVICE_ACCOUNT_JSON)
+        analise = ctx.get('analise_perfil')
+        if _r is None:
+            if to_sheet:
+                _buffer_lead(user_id, row, analise)
+            return
+        try:
+            payload = orjson.dumps(row)
+            async with _r.pipeline(transaction=False) as pipe:
+                if to_sheet:
+                    pipe.rpush(_LEADS_PENDING_KEY, orjson.dumps({"row": row, "analise": analise}))
+                pipe.rpush("leads_records", payload)
+                pipe.ltrim("leads_records", -_LEADS_RECORDS_MAX, -1)
+                pipe.set(f"lead_final:{user_id}", payload, ex=_CTX_TTL_SEC)
+                res = await pipe.execute()
+            if to_sheet and res[0] >= _LEADS_BATCH_MAX:
+                _LEADS_FLUSH_NOW.set()
+        except Exception as rex:
+            logger.warning("redis save lead error: %s", rex)
+            if to_sheet:
+                _buffer_lead(user_id, row, analise)
+    except Exception:
+        logger.exception("save lead error")
+
+def _save_lead_record_in_background(user_id: str) -> None:
+    """Grava o lead fora do caminho do webhook (planilha + Redis levam vários round-trips).
+
+    O contexto já foi salvo pelo chamador; a task o relê do Redis/memória.
+    """
+    _run_in_background(_save_lead_record(user_id))
 
-def _download_whatsapp_media(media_id: str) -> Optional[Dict[str, Any]]:
+async def _download_whatsapp_media(media_id: str) -> Optional[Dict[str, Any]]:
     try:
-        token = os.environ["WHATSAPP_ACCESS_TOKEN"]
-        meta = requests.get(
-            f"https://graph.facebook.com/v19.0/{media_id}",
-            headers={"Authorization": f"Bearer {token}"},
+        client = _get_http()
+        meta = await client.get(
+            f"{_GRAPH_URL}/{media_id}",
+            headers=_MEDIA_AUTH_HEADERS,
             timeout=30,
         )
         meta.raise_for_status()
-        j = meta.json()
+        j = orjson.loads(meta.content)
         url = j.get("url")
         mime = j.get("mime_type") or j.get("mime")
         if not url:
             return None
-        binr = requests.get(url, headers={"Authorization": f"Bearer {token}"}, timeout=60)
+        binr = await client.get(url, headers=_MEDIA_AUTH_HEADERS, timeout=60)
         binr.raise_for_status()
         return {"bytes": binr.content, "mime_type": mime or "audio/ogg"}
     except Exception as exc:
-        print(f"download media error: {exc}")
+        logger.warning("download media error: %s", exc)
         return None
 
+_AUDIO_TRANSCRIBE_MODEL = os.environ.get("AUDIO_TRANSCRIBE_MODEL") or AGENT_MODEL
+
+@functools.lru_cache(maxsize=4)
+def _generative_model(model_name: str) -> "genai.GenerativeModel":
+    """Uma instância de ``GenerativeModel`` por nome de modelo, reaproveitada entre chamadas."""
+    return genai.GenerativeModel(model_name)
+
+# Chamadas simultâneas ao Gemini por processo: um pico de áudios/pings não vira avalanche no backend.
+_GEMINI_SEM = asyncio.Semaphore(int(os.environ.get("GEMINI_MAX_CONC", "16")))
+
 def _transcribe_audio_gemini(data: bytes, mime_type: str) -> Optional[str]:
     try:
-        model_name = os.environ.get("AUDIO_TRANSCRIBE_MODEL") or AGENT_MODEL
-        model = genai.GenerativeModel(model_name)
+        model = _generative_model(_AUDIO_TRANSCRIBE_MODEL)
         parts = [
             {"mime_type": mime_type or "audio/ogg", "data": data},
             {"text": "Transcreva o áudio em português do Brasil. Responda apenas com a transcrição, sem comentários."},
@@ -886,10 +1416,10 @@ def _transcribe_audio_gemini(data: bytes, mime_type: str) -> Optional[str]:
         resp = model.generate_content(parts)
         return getattr(resp, "text", None)
     except Exception as exc:
-        print(f"audio transcribe error: {exc}")
+        logger.warning("audio transcribe error: %s", exc)
         return None
 
-def processar_resposta_do_agente(destino: str, resposta: Dict[str, Any]) -> None:
+async def processar_resposta_do_agente(destino: str, resposta: Dict[str, Any]) -> None:
     """Processa a resposta do ADK e envia ao usuário via WhatsApp."""
     content = resposta.get("content")
     options = resposta.get("options")
@@ -900,26 +1430,471 @@ def processar_resposta_do_agente(destino: str, resposta: Dict[str, Any]) -> None
 
     if options:
         if len(options) > 3:
-            send_list_message(destino, content or "Selecione uma opção:", options)
+            await send_list_message_async(destino, content or "Selecione uma opção:", options)
         else:
-            send_button_message(destino, content or "Selecione uma opção:", options)
+            await send_button_message_async(destino, content or "Selecione uma opção:", options)
+    else:
+        await send_text_message_async(destino, content or "Desculpe, não consegui entender.")
+
+async def _responder_com_agente(user_id: str, texto: str, stage: Optional[str]) -> None:
+    try:
+        agent_response = await enviar_mensagem_ao_agente_async(user_id, texto, stage=stage)
+        await processar_resposta_do_agente(user_id, agent_response)
+    except Exception:
+        logger.exception("Agent pipeline error")
+        try:
+            await send_text_message_async(
+                user_id,
+                "Não consegui processar sua mensagem agora. Tente novamente em instantes.",
+            )
+        except Exception as send_err:
+            logger.warning("Fallback send error: %s", send_err)
+
+# Agrupamento de mensagens em rajada: no WhatsApp é comum mandar várias frases
+# curtas seguidas; em vez de rodar o agente para cada uma, esperamos uma pequena
+# janela sem novas mensagens (limitada a _AGENT_DEBOUNCE_MAX_SEC desde a primeira)
+# e enviamos o texto concatenado uma única vez. 0 desativa.
+_AGENT_DEBOUNCE_SEC = float(os.environ.get("AGENT_DEBOUNCE_SEC", "1.5"))
+_AGENT_DEBOUNCE_MAX_SEC = float(os.environ.get("AGENT_DEBOUNCE_MAX_SEC", "5"))
+_BUFFER: Dict[str, List[str]] = {}
+_BUFFER_STARTED: Dict[str, float] = {}
+_PENDING: Dict[str, asyncio.Task] = {}
+_AGENT_LOCKS: Dict[str, List[Any]] = {}  # user_id -> [lock, usuários do lock]
+_BACKGROUND_TASKS: Set[asyncio.Task] = set()
+
+def _run_in_background(coro: Any) -> asyncio.Task:
+    """Cria a task mantendo uma referência forte até ela terminar."""
+    task = asyncio.create_task(coro)
+    _BACKGROUND_TASKS.add(task)
+    task.add_done_callback(_BACKGROUND_TASKS.discard)
+    return task
+
+async def _flush_after(user_id: str, delay: float, stage: Optional[str]) -> None:
+    await asyncio.sleep(delay)
+    # Sem await entre o fim do sleep e aqui: depois deste ponto a task não é mais cancelada.
+    _PENDING.pop(user_id, None)
+    _BUFFER_STARTED.pop(user_id, None)
+    texto = "\n".join(_BUFFER.pop(user_id, []))
+    if not texto:
+        return
+    # Uma execução do agente por usuário de cada vez, na ordem de chegada.
+    entry = _AGENT_LOCKS.setdefault(user_id, [asyncio.Lock(), 0])
+    entry[1] += 1
+    try:
+        async with entry[0]:
+            await _responder_com_agente(user_id, texto, stage)
+    finally:
+        entry[1] -= 1
+        if not entry[1]:
+            _AGENT_LOCKS.pop(user_id, None)
+
+async def _queue_agent_message(user_id: str, texto: str, stage: Optional[str], immediate: bool = False) -> None:
+    """Acumula ``texto`` e (re)agenda o envio ao agente ao fim da janela de agrupamento."""
+    if _AGENT_DEBOUNCE_SEC <= 0:
+        await _responder_com_agente(user_id, texto, stage)
+        return
+    _BUFFER.setdefault(user_id, []).append(texto)
+    now = time.monotonic()
+    started = _BUFFER_STARTED.setdefault(user_id, now)
+    delay = 0.0 if immediate else min(_AGENT_DEBOUNCE_SEC, max(0.0, started + _AGENT_DEBOUNCE_MAX_SEC - now))
+    pending = _PENDING.pop(user_id, None)
+    if pending is not None:
+        pending.cancel()
+    _PENDING[user_id] = _run_in_background(_flush_after(user_id, delay, stage))
+
+# Fluxo determinístico: comandos e etapas resolvidos por tabela, montada uma vez na importação.
+# Chaves já sem acento e em minúsculas (ver ``txt_norm`` no webhook).
+_CMD_TABLE: Dict[str, str] = {
+    "menu": "menu",
+    "voltar": "voltar",
+    "recomecar": "recomecar",
+    "ajuda": "ajuda",
+    "help": "ajuda",
+    "humano": "humano",
+    "atendente": "humano",
+    "suporte": "humano",
+    "status": "status",
+    "progresso": "status",
+    "comandos": "comandos",
+    "comando": "comandos",
+    "help comandos": "comandos",
+}
+
+def _stage_key(stage: Optional[str]) -> str:
+    """Chave de despacho da etapa: ``intro_3`` -> ``intro_``, ``disc_q2`` -> ``disc_q``."""
+    return str(stage or "").rstrip("0123456789")
+
+async def _stage_await_city(user_id: str, ctx: Dict[str, Any], texto: str, yn: Optional[bool]) -> bool:
+    return (await _handle_city_selection(user_id, user_id, texto, ctx=ctx)).get("handled", False)
+
+async def _stage_await_city_reject(user_id: str, ctx: Dict[str, Any], texto: str, yn: Optional[bool]) -> bool:
+    return (await _handle_city_selection_reject(user_id, user_id, texto)).get("handled", False)
+
+async def _stage_intro(user_id: str, ctx: Dict[str, Any], texto: str, yn: Optional[bool]) -> bool:
+    if yn is True:
+        await _send_city_menu(user_id, user_id, ctx=ctx, stage="await_city", from_intro=True)
+        return True
+    if yn is False:
+        await send_text_message_async(user_id, "Tudo bem. Fico a disposição para futuras oportunidades. Obrigada!")
+        await _save_ctx_fields(user_id, stage="final")
+        return True
+    await _resend_last_menu(user_id, ctx)
+    return True
+
+# Requisito -> (próxima etapa, confirmação). O último (req_android) decide entre DISC e encerramento.
+_REQ_NEXT: Dict[str, Tuple[str, str]] = {
+    "req_moto": ("req_cnh", "Ótimo, obrigada pela confirmação."),
+    "req_cnh": ("req_android", "Perfeito, mais uma pergunta rápida."),
+}
+
+async def _stage_requirement(user_id: str, ctx: Dict[str, Any], texto: str, yn: Optional[bool]) -> bool:
+    if yn is None:
+        return False
+    stage = ctx["stage"]
+    answer = {stage: bool(yn)}
+    if stage in _REQ_NEXT:
+        next_stage, ack = _REQ_NEXT[stage]
+        await send_text_message_async(user_id, ack)
+        await _send_requirement_question(user_id, next_stage, user_id=user_id, ctx=ctx, stage=next_stage, **answer)
+        return True
+    ctx.update(answer)
+    if ctx.get("req_moto") and ctx.get("req_cnh") and ctx.get("req_android"):
+        await send_text_message_async(user_id, "Excelente! Agora vou fazer 5 perguntas rápidas para entender seu perfil.")
+        await _send_disc_question(user_id, 0, user_id=user_id, ctx=ctx, stage="disc_q0", disc_answers=[], **answer)
+    else:
+        await send_text_message_async(user_id, "Obrigada pelo interesse. No momento, os requisitos necessários não foram atendidos.")
+        await _save_ctx_fields(user_id, stage="final", **answer)
+    return True
+
+async def _stage_disc(user_id: str, ctx: Dict[str, Any], texto: str, yn: Optional[bool]) -> bool:
+    try:
+        q_idx = int(ctx["stage"].replace("disc_q", ""))
+    except Exception:
+        q_idx = 0
+    ans_id = _map_disc_selection(q_idx, texto)
+    if not ans_id:
+        return False
+    answers = (ctx.get("disc_answers") or []) + [ans_id]
+    if q_idx + 1 < len(_DISC_QUESTIONS):
+        await _send_disc_question(user_id, q_idx+1, user_id=user_id, ctx=ctx, stage=f"disc_q{q_idx+1}", disc_answers=answers)
+        return True
+    totals = [sum(col) for col in zip(_DISC_ZERO, *(_DISC_ANSWER_TABLE.get(a, _DISC_ZERO) for a in answers))]
+    score = totals[0]
+    trait_scores = dict(zip(_DISC_TRAITS, totals[1:]))
+    profile_desc = "Perfil do Candidato:\n"
+    for trait, points in trait_scores.items():
+        profile_desc += f"- {trait}: {points} pontos\n"
+    top = max(trait_scores.values())
+    dominant_traits = [t for t, pts in trait_scores.items() if pts == top]
+    if dominant_traits:
+        profile_desc += "\nTraços dominantes: " + ", ".join(dominant_traits) + ".\n"
+        if "D" in dominant_traits: profile_desc += "Indica foco em resultados e proatividade.\n"
+        if "I" in dominant_traits: profile_desc += "Indica habilidade de comunicação e persuasão.\n"
+        if "S" in dominant_traits: profile_desc += "Indica estabilidade e paciência.\n"
+        if "C" in dominant_traits: profile_desc += "Indica atenção a detalhes e conformidade.\n"
+    else:
+        profile_desc += "Não foi possível identificar traços dominantes claros.\n"
+    aprovado = score >= 3
+    if aprovado:
+        await send_text_message_async(user_id, "Parabéns! Você foi aprovado(a).")
+        await _send_vagas_menu(user_id, ctx.get("cidade") or "")
     else:
-        send_text_message(destino, content or "Desculpe, não consegui entender.")
+        await send_text_message_async(user_id, "Obrigado por participar. Neste momento, não seguiremos adiante.")
+    # Resultado do DISC e a próxima etapa numa única escrita.
+    await _save_ctx_fields(
+        user_id,
+        disc_answers=answers,
+        disc_score=score,
+        disc_trait_scores=trait_scores,
+        analise_perfil=profile_desc,
+        aprovado=aprovado,
+        stage="offer_positions" if aprovado else "final",
+    )
+    return True
+
+async def _stage_offer_positions(user_id: str, ctx: Dict[str, Any], texto: str, yn: Optional[bool]) -> bool:
+    cidade = ctx.get("cidade") or ""
+    vaga = await _find_vaga_by_row_title(cidade, texto)
+    if not vaga:
+        await send_text_message_async(user_id, "Não entendi a vaga selecionada. Por favor, escolha uma das opções do menu de vagas.")
+        await _send_vagas_menu(user_id, cidade, user_id=user_id, ctx=ctx)
+        return True
+    link_url = "https://app.pipefy.com/public/form/v2m7kpB-"
+    det_vid = vaga.get("vaga_id")
+    det_farm = vaga.get("farmacia")
+    det_turno = vaga.get("turno")
+    det_taxa = vaga.get("taxa_entrega")
+    await send_text_message_async(user_id, (
+        f"Vaga selecionada:\n"
+        f"• ID: {det_vid}\n• Farmácia: {det_farm}\n• Turno: {det_turno}\n• Taxa: {det_taxa}"
+    ))
+    await send_text_message_async(user_id, (
+        f"Excelente! Sua manifestação de interesse na vaga ID {det_vid} foi registrada com sucesso.\n"
+        f"Para dar o próximo passo em sua jornada de associação à CoopMob, por favor, preencha o formulário de cadastro: {link_url}.\n\n"
+        "Nossa equipe entrará em contato em breve para dar continuidade ao seu processo de ingresso na cooperativa. Agradecemos seu interesse em fazer parte da nossa comunidade de entregadores cooperados!"
+    ))
+    await _save_ctx_fields(user_id, vaga=vaga, stage="final")
+    _save_lead_record_in_background(user_id)
+    return True
+
+# Etapa (ver _stage_key) -> handler(user_id, ctx, texto, sim/não já normalizado).
+# True: mensagem tratada; False: segue para o reenvio do menu / agente.
+_STAGE_HANDLERS: Dict[str, Callable[[str, Dict[str, Any], str, Optional[bool]], Awaitable[bool]]] = {
+    "await_city": _stage_await_city,
+    "await_city_reject": _stage_await_city_reject,
+    "intro_": _stage_intro,
+    "req_moto": _stage_requirement,
+    "req_cnh": _stage_requirement,
+    "req_android": _stage_requirement,
+    "disc_q": _stage_disc,
+    "offer_positions": _stage_offer_positions,
+}
+
+# Etapas guiadas por menu: texto não reconhecido reenvia o último menu em vez de ir ao agente.
+_MENU_STAGES = frozenset({"", "intro_", "await_city", "req_moto", "req_cnh", "req_android", "offer_positions", "disc_q"})
+
+async def _process_user_text(
+    from_number: str,
+    ctx: Dict[str, Any],
+    texto_usuario: str,
+    *,
+    was_audio: bool = False,
+    interactive: bool = False,
+) -> Dict[str, Any]:
+    """Fluxo a partir do texto já extraído da mensagem (texto, clique ou áudio transcrito).
+
+    ``interactive``: clique em botão/lista. O id já é a resposta da etapa, então
+    retomada e comandos (só digitados) são pulados.
+    """
+    if not (texto_usuario or "").strip():
+        if was_audio:
+            await send_text_message_async(from_number, "Não consegui entender seu áudio. Pode escrever a mensagem?")
+        return {"status": "ignored"}
+
+    # Normalizado uma vez por mensagem: comandos e respostas sim/não usam a mesma forma.
+    txt_norm = _strip_accents(texto_usuario).strip().lower()
+    yn_norm = _normalize_yes_no(txt_norm)
+
+    stage = str(ctx.get("stage") or "")
+    # "intro_3" -> "intro_", "disc_q2" -> "disc_q"; demais etapas ficam iguais.
+    stage_key = _stage_key(stage)
+
+    if not stage and INTRO_BEFORE_CITY:
+        await _save_ctx_fields(
+            from_number, stage="intro_1", intro_idx=1, invalid_count=0, off_context_count=0, last_message_at=_now()
+        )
+        await send_intro_message_async(from_number, from_number, 1, ctx.get("nome", "candidato(a)"))
+        return {"status": "handled"}
+
+    if not stage:
+        await _send_city_menu(
+            from_number, from_number, ctx=ctx,
+            stage="await_city", invalid_count=0, off_context_count=0, last_message_at=_now(),
+        )
+        return {"status": "handled"}
+
+    if stage == "final":
+        await send_text_message_async(from_number, "O atendimento foi finalizado. Em breve, alguém da nossa equipe entrará em contato pelos canais oficiais de atendimento da CoopMob.")
+        return {"status": "handled"}
+
+    # Early handle: if user declines during intro, collect city for registry
+    if stage_key == "intro_" and yn_norm is False:
+        prompt = (
+            "Antes de encerrar, em qual cidade você atua como entregador?\n"
+            "Selecione uma opção abaixo"
+        )
+        await _send_city_menu(from_number, from_number, ctx=ctx, prompt=prompt, stage="await_city_reject")
+        return {"status": "handled"}
+
+    try:
+        last_ts = float(ctx.get("last_message_at") or 0)
+        if not interactive and _now() - last_ts > RECAP_AFTER_MINUTES * 60 and ctx.get("last_menu"):
+            await send_text_message_async(from_number, "Retomando de onde paramos. Aqui estão as opções novamente 👇")
+            if await _resend_last_menu(from_number, ctx):
+                await _save_ctx_fields(from_number, last_message_at=_now())
+                return {"status": "handled"}
+    except Exception:
+        pass
+
+    cmd = "" if interactive else _CMD_TABLE.get(txt_norm, "")
+    if cmd == "recomecar":
+        ctx = {"stage": "await_city", "invalid_count": 0, "off_context_count": 0, "last_message_at": _now()}
+        await _save_ctx(from_number, ctx)
+        await _send_city_menu(from_number, from_number, ctx=ctx)
+        return {"status": "handled"}
+    if cmd == "menu" and ctx.get("last_menu"):
+        await send_text_message_async(from_number, "Claro! Aqui estão as opções novamente 👇")
+        await _resend_last_menu(from_number, ctx)
+        await _save_ctx_fields(from_number, last_message_at=_now())
+        return {"status": "handled"}
+    if cmd == "voltar":
+        async def back_to(prev_stage: str):
+            ctx["stage"] = prev_stage
+            ctx["invalid_count"] = 0
+            await _save_ctx_fields(from_number, stage=prev_stage, invalid_count=0)
+        if stage_key == "intro_":
+            try:
+                qi = int(stage[len(stage_key):])
+            except Exception:
+                qi = 0
+            if qi > 1:
+                await back_to(f"intro_{qi-1}")
+                await send_intro_message_async(from_number, from_number, qi-1, ctx.get("nome", "candidato(a)"))
+            else:
+                await back_to("await_city")
+                await _send_city_menu(from_number, from_number, ctx=ctx)
+            return {"status": "handled"}
+        if stage_key == "disc_q":
+            try:
+                qi = int(stage[len(stage_key):])
+            except Exception:
+                qi = 0
+            if qi > 0:
+                await back_to(f"disc_q{qi-1}")
+                await _send_disc_question(from_number, qi-1, user_id=from_number, ctx=ctx)
+            else:
+                await back_to("req_android")
+                await _send_requirement_question(from_number, "req_android", user_id=from_number, ctx=ctx)
+            return {"status": "handled"}
+        if stage == "offer_positions":
+            await _resend_last_menu(from_number, ctx) or await _send_vagas_menu(from_number, ctx.get("cidade") or "", user_id=from_number)
+            return {"status": "handled"}
+        if stage == "req_android":
+            await back_to("req_cnh"); await _send_requirement_question(from_number, "req_cnh", user_id=from_number, ctx=ctx); return {"status": "handled"}
+        if stage == "req_cnh":
+            await back_to("req_moto"); await _send_requirement_question(from_number, "req_moto", user_id=from_number, ctx=ctx); return {"status": "handled"}
+        if stage == "req_moto":
+            await back_to("await_city"); await _send_city_menu(from_number, from_number, ctx=ctx); return {"status": "handled"}
+        if await _resend_last_menu(from_number, ctx):
+            return {"status": "handled"}
+    if cmd == "ajuda":
+        tips = {
+            "await_city": "Toque em uma das cidades do menu para continuar.",
+            "req_moto": "Responda tocando em Sim ou Não.",
+            "req_cnh": "Responda tocando em Sim ou Não.",
+            "req_android": "Responda tocando em Sim ou Não.",
+            "offer_positions": "Toque em uma vaga do menu para selecionar.",
+        }
+        await send_text_message_async(from_number, "Ajuda: " + (tips.get(stage, "Selecione uma opcao do menu abaixo.")) + "\nDigite 'comandos' para ver a lista completa de comandos.")
+        await _resend_last_menu(from_number, ctx)
+    if cmd == "comandos":
+        guide = (
+            "Guia rapido de comandos:\n"
+            "- menu: reenvia o ultimo menu\n"
+            "- voltar: volta uma etapa\n"
+            "- recomecar: inicia do zero\n"
+            "- status: mostra etapa, cidade, requisitos e progresso\n"
+            "- ajuda: dica da etapa atual\n"
+            "- humano: encaminhar para atendimento humano\n\n"
+            "Dica: responda tocando nas opcoes quando possivel."
+        )
+        await send_text_message_async(from_number, guide)
+        if ctx.get("last_menu"): await _resend_last_menu(from_number, ctx)
+        return {"status": "handled"}
+    if cmd == "status":
+        st_map = {
+            "await_city": "Aguardando seleção de cidade",
+            "req_moto": "Confirmando: moto com documentação em dia",
+            "req_cnh": "Confirmando: CNH A ativa",
+            "req_android": "Confirmando: dispositivo Android",
+            "disc_q0": "Questionário DISC (1/5)",
+            "disc_q1": "Questionário DISC (2/5)",
+            "disc_q2": "Questionário DISC (3/5)",
+            "disc_q3": "Questionário DISC (4/5)",
+            "disc_q4": "Questionário DISC (5/5)",
+            "offer_positions": "Apresentando vagas disponíveis",
+            "final": "Atendimento concluído",
+        }
+        nome = ctx.get("nome") or "Entregador(a)"
+        cidade = ctx.get("cidade") or "—"
+        reqs = [
+            f"Moto: {'Sim' if ctx.get('req_moto') else 'Não' if ctx.get('req_moto') is False else '—'}",
+            f"CNH A: {'Sim' if ctx.get('req_cnh') else 'Não' if ctx.get('req_cnh') is False else '—'}",
+            f"Android: {'Sim' if ctx.get('req_android') else 'Não' if ctx.get('req_android') is False else '—'}",
+        ]
+        disc_prog = ctx.get("disc_answers") or []
+        msg = (
+            f"Status de {nome}:\n"
+            f"• Etapa: {st_map.get(stage, '—')}\n"
+            f"• Cidade: {cidade}\n"
+            f"• Requisitos: {', '.join(reqs)}\n"
+            f"• DISC: {len(disc_prog)}/5 respondidas\n"
+        )
+        if ctx.get('disc_score') is not None:
+            msg += f"• Pontuação DISC: {ctx.get('disc_score')}\n"
+        if ctx.get('analise_perfil'):
+            msg += f"• Análise de Perfil:\n{ctx.get('analise_perfil')}\n"
+        msg += "\nDicas: digite 'menu' para ver as opções, 'voltar' para a etapa anterior ou 'recomeçar' para iniciar do zero."
+        await send_text_message_async(from_number, msg)
+        if ctx.get("last_menu"):
+            await _resend_last_menu(from_number, ctx)
+        return {"status": "handled"}
+    if cmd == "humano":
+        await send_text_message_async(from_number, "Sem problemas! Vou pedir para nossa equipe te chamar. Você também pode preencher o formulário: https://app.pipefy.com/public/form/v2m7kpB-")
+        _save_lead_record_in_background(from_number)
+        await _save_ctx_fields(from_number, stage="final")
+        return {"status": "handled"}
+
+    handler = _STAGE_HANDLERS.get(stage_key)
+    if handler is not None:
+        try:
+            if await handler(from_number, ctx, texto_usuario, yn_norm):
+                return {"status": "handled"}
+        except WhatsAppError:
+            raise
+        except Exception:
+            logger.exception("flow error")
+
+    if stage_key in _MENU_STAGES:
+        try:
+            await _resend_last_menu(from_number, ctx)
+        except WhatsAppError:
+            raise
+        except Exception:
+            pass
+        return {"status": "handled"}
+    # Cliques em opções não esperam a janela de agrupamento.
+    await _queue_agent_message(from_number, texto_usuario, stage, immediate=interactive)
+    return {"status": "handled"}
+
+async def _process_audio_message(user_id: str, media_id: str) -> None:
+    """Baixa e transcreve o áudio fora do webhook e segue o fluxo com o texto obtido."""
+    try:
+        mdat = await _download_whatsapp_media(media_id)
+        if not mdat or not mdat.get("bytes"):
+            return
+        async with _GEMINI_SEM:
+            texto = await run_in_threadpool(_transcribe_audio_gemini, mdat["bytes"], mdat.get("mime_type") or "audio/ogg") or ""
+        await _process_user_text(user_id, await _load_ctx(user_id), texto, was_audio=True)
+    except WhatsAppError as exc:
+        await _record_wa_error(user_id, exc)
+    except Exception:
+        logger.exception("audio handle error")
+
+class _OrjsonResponse(JSONResponse):
+    """``JSONResponse`` serializado com orjson (o ``ORJSONResponse`` do FastAPI está depreciado)."""
+
+    def render(self, content: Any) -> bytes:
+        return orjson.dumps(content)
 
 # FastAPI Web Server
-app = FastAPI(lifespan=lifespan)
+app = FastAPI(lifespan=lifespan, default_response_class=_OrjsonResponse)
+# Respostas pequenas (webhook, 200 "ok") passam direto; só os relatórios maiores são comprimidos.
+app.add_middleware(GZipMiddleware, minimum_size=500)
+# Lidos uma vez: verificação do webhook e proteção dos endpoints de teste.
+_VERIFY_TOKEN = os.environ.get("VERIFY_TOKEN")
+_INTERNAL_API_TOKEN = os.environ.get("INTERNAL_API_TOKEN")
 
 @app.get("/")
-def healthcheck():
+async def healthcheck():
     return {"status": "ok"}
 
 @app.get("/webhook")
-def verify_webhook(request: Request):
+async def verify_webhook(request: Request):
     """Endpoint para a verificação do webhook do WhatsApp."""
-    verify_token = os.environ.get("VERIFY_TOKEN")
     if (
         request.query_params.get("hub.mode") == "subscribe"
-        and request.query_params.get("hub.verify_token") == verify_token
+        and request.query_params.get("hub.verify_token") == _VERIFY_TOKEN
     ):
         challenge = request.query_params.get("hub.challenge", "")
         return PlainTextResponse(content=str(challenge))
@@ -935,44 +1910,21 @@ async def handle_webhook(request: Request):
             return {"status": "ignored"}
         msg = messages[0]
         from_number = msg.get("from", "")
-        try:
-            msg_id = msg.get("id")
-            if msg_id:
-                if _r is not None:
-                    try:
-                        ok = _r.set(f"seen_msg:{msg_id}", "1", nx=True, ex=int(_SEEN_TTL_SEC))
-                        if not ok:
-                            return {"status": "handled_duplicate"}
-                    except Exception as _rexc:
-                        print(f"redis dedup error: {_rexc}")
-                else:
-                    now = time.time()
-                    try:
-                        expired = [k for k, ts in list(_SEEN_MSG_IDS.items()) if ts < now]
-                        for k in expired:
-                            _SEEN_MSG_IDS.pop(k, None)
-                    except Exception:
-                        pass
-                    if msg_id in _SEEN_MSG_IDS:
-                        return {"status": "handled_duplicate"}
-                    _SEEN_MSG_IDS[msg_id] = now + _SEEN_TTL_SEC
-        except Exception:
-            pass
+        claimed, ctx = await _claim_and_load_ctx(msg.get("id"), from_number)
+        if not claimed:
+            return {"status": "handled_duplicate"}
         try:
             contacts = entry.get("contacts") or []
             profile_name = None
             if contacts:
                 profile_name = ((contacts[0] or {}).get("profile") or {}).get("name")
-            if profile_name:
-                _ctx_tmp = _load_ctx(from_number) or {}
-                if not _ctx_tmp.get("nome"):
-                    _ctx_tmp["nome"] = str(profile_name)
-                    _save_ctx(from_number, _ctx_tmp)
+            if profile_name and not ctx.get("nome"):
+                ctx["nome"] = str(profile_name)
+                await _save_ctx_fields(from_number, nome=ctx["nome"])
         except Exception:
             pass
 
         texto_usuario = ""
-        was_audio = False
         try:
             mtype = msg.get("type")
             if mtype == "text":
@@ -986,7 +1938,7 @@ async def handle_webhook(request: Request):
                     btitle = br.get("title", "")
                     texto_usuario = bid or btitle
                     if bid in ("intro_next", "intro_skip"):
-                        _handle_intro_action(from_number, from_number, bid)
+                        await _handle_intro_action(from_number, from_number, bid)
                         return {"status": "handled"}
                 elif itype == "list_reply":
                     lr = interactive.get("list_reply", {})
@@ -997,420 +1949,90 @@ async def handle_webhook(request: Request):
                 media = msg.get("audio", {}) or {}
                 mid = media.get("id")
                 if mid:
-                    try:
-                        mdat = _download_whatsapp_media(mid)
-                        if mdat and mdat.get("bytes"):
-                            texto_usuario = _transcribe_audio_gemini(mdat["bytes"], mdat.get("mime_type") or "audio/ogg") or ""
-                            was_audio = True
-                    except Exception as aexc:
-                        print(f"audio handle error: {aexc}")
+                    # Transcrição leva segundos: confirma o recebimento e segue em segundo plano.
+                    await send_text_message_async(from_number, "Recebi seu áudio, processando…")
+                    _run_in_background(_process_audio_message(from_number, mid))
+                    return {"status": "handled"}
+        except WhatsAppError:
+            raise
         except Exception:
             texto_usuario = ""
 
-        if not (texto_usuario or "").strip():
-            if was_audio:
-                try:
-                    send_text_message(from_number, "Não consegui entender seu áudio. Pode escrever a mensagem?")
-                except Exception:
-                    pass
-            return {"status": "ignored"}
-
-        ctx = _load_ctx(from_number) or {}
-        stage = ctx.get("stage")
-
-        INTRO_BEFORE_CITY = _env_true("INTRO_BEFORE_CITY", default=True)
-
-        if not stage and INTRO_BEFORE_CITY:
-            ctx["stage"] = "intro_1"
-            ctx["intro_idx"] = 1
-            ctx["invalid_count"] = 0
-            ctx["off_context_count"] = 0
-            ctx["last_message_at"] = _now()
-            _save_ctx(from_number, ctx)
-            send_intro_message(from_number, from_number, 1, ctx.get("nome", "candidato(a)"))
-            return {"status": "handled"}
-
-        if not stage:
-            ctx["stage"] = "await_city"
-            ctx["invalid_count"] = 0
-            ctx["off_context_count"] = 0
-            ctx["last_message_at"] = _now()
-            _save_ctx(from_number, ctx)
-            _send_city_menu(from_number, from_number, ctx=ctx)
-            return {"status": "handled"}
-
-        if stage == "final":
-            send_text_message(from_number, "O atendimento foi finalizado. Em breve, alguém da nossa equipe entrará em contato pelos canais oficiais de atendimento da CoopMob.")
-            return {"status": "handled"}
-        
-        # Early handle: if user declines during intro, collect city for registry
-        try:
-            st_intro = str(ctx.get("stage") or "")
-            yn_pre = _normalize_yes_no(_strip_accents(texto_usuario))
-        except Exception:
-            yn_pre = None
-        if st_intro.startswith("intro_") and yn_pre is False:
-            ctx["stage"] = "await_city_reject"
-            _save_ctx(from_number, ctx)
-            prompt = (
-                "Antes de encerrar, em qual cidade você atua como entregador?\n"
-                "Selecione uma opção abaixo"
-            )
-            _send_city_menu(from_number, from_number, ctx=ctx, prompt=prompt)
-            return {"status": "handled"}
+        return await _process_user_text(
+            from_number, ctx, texto_usuario, interactive=msg.get("type") == "interactive"
+        )
+    except WhatsAppError as exc:
+        # Já logado pelo envio; 429 já pausou os envios em _post_message.
+        await _record_wa_error(from_number, exc)
+        return {"status": "ignored", "error": str(exc)}
+    except Exception as exc:
+        logger.exception("Webhook error")
+        return {"status": "ignored", "error": str(exc)}
 
-        try:
-            last_ts = float(ctx.get("last_message_at") or 0)
-            if _now() - last_ts > RECAP_AFTER_MINUTES * 60 and ctx.get("last_menu"):
-                send_text_message(from_number, "Retomando de onde paramos. Aqui estão as opções novamente 👇")
-                if _resend_last_menu(from_number, ctx):
-                    ctx["last_message_at"] = _now()
-                    _save_ctx(from_number, ctx)
-                    return {"status": "handled"}
-        except Exception:
-            pass
+# Test endpoints
+_bearer = HTTPBearer(auto_error=False)
 
-        def _cmd(txt: str) -> str:
-            t = (txt or "").strip().lower()
-            if t in {"menu"}: return "menu"
-            if t in {"voltar"}: return "voltar"
-            if t in {"recomecar", "recomeçar"}: return "recomecar"
-            if t in {"ajuda", "help"}: return "ajuda"
-            if t in {"humano", "atendente", "suporte"}: return "humano"
-            if t in {"status", "progresso"}: return "status"
-            if t in {"comandos", "comando", "help comandos"}: return "comandos"
-            return ""
-
-        cmd = _cmd(texto_usuario)
-        if cmd == "recomecar":
-            ctx = {"stage": "await_city", "invalid_count": 0, "off_context_count": 0, "last_message_at": _now()}
-            _save_ctx(from_number, ctx)
-            _send_city_menu(from_number, from_number, ctx=ctx)
-            return {"status": "handled"}
-        if cmd == "menu" and ctx.get("last_menu"):
-            send_text_message(from_number, "Claro! Aqui estão as opções novamente 👇")
-            _resend_last_menu(from_number, ctx)
-            ctx["last_message_at"] = _now()
-            _save_ctx(from_number, ctx)
-            return {"status": "handled"}
-        if cmd == "voltar":
-            st = str(ctx.get("stage") or "")
-            def back_to(prev_stage: str):
-                ctx["stage"] = prev_stage
-                ctx["invalid_count"] = 0
-                _save_ctx(from_number, ctx)
-            if st.startswith("intro"):
-                try:
-                    qi = int(st.replace("intro_", ""))
-                except Exception:
-                    qi = 0
-                if qi > 1:
-                    back_to(f"intro_{qi-1}")
-                    send_intro_message(from_number, from_number, qi-1, ctx.get("nome", "candidato(a)"))
-                else:
-                    back_to("await_city")
-                    _send_city_menu(from_number, from_number, ctx=ctx)
-                return {"status": "handled"}
-            if st.startswith("disc_q"):
-                try:
-                    qi = int(st.replace("disc_q", ""))
-                except Exception:
-                    qi = 0
-                if qi > 0:
-                    back_to(f"disc_q{qi-1}")
-                    _send_disc_question(from_number, qi-1, user_id=from_number)
-                else:
-                    back_to("req_android")
-                    _send_requirement_question(from_number, "req_android", user_id=from_number)
-                return {"status": "handled"}
-            if st == "offer_positions":
-                _resend_last_menu(from_number, ctx) or _send_vagas_menu(from_number, ctx.get("cidade") or "", user_id=from_number)
-                return {"status": "handled"}
-            if st == "req_android":
-                back_to("req_cnh"); _send_requirement_question(from_number, "req_cnh", user_id=from_number); return {"status": "handled"}
-            if st == "req_cnh":
-                back_to("req_moto"); _send_requirement_question(from_number, "req_moto", user_id=from_number); return {"status": "handled"}
-            if st == "req_moto":
-                back_to("await_city"); _send_city_menu(from_number, from_number, ctx=ctx); return {"status": "handled"}
-            if _resend_last_menu(from_number, ctx):
-                return {"status": "handled"}
-        if cmd == "ajuda":
-            st = str(ctx.get("stage") or "")
-            tips = {
-                "await_city": "Toque em uma das cidades do menu para continuar.",
-                "req_moto": "Responda tocando em Sim ou Não.",
-                "req_cnh": "Responda tocando em Sim ou Não.",
-                "req_android": "Responda tocando em Sim ou Não.",
-                "offer_positions": "Toque em uma vaga do menu para selecionar.",
-            }
-            send_text_message(from_number, "Ajuda: " + (tips.get(st, "Selecione uma opcao do menu abaixo.")) + "\nDigite 'comandos' para ver a lista completa de comandos.")
-            _resend_last_menu(from_number, ctx)
-        if cmd == "comandos":
-            guide = (
-                "Guia rapido de comandos:\n"
-                "- menu: reenvia o ultimo menu\n"
-                "- voltar: volta uma etapa\n"
-                "- recomecar: inicia do zero\n"
-                "- status: mostra etapa, cidade, requisitos e progresso\n"
-                "- ajuda: dica da etapa atual\n"
-                "- humano: encaminhar para atendimento humano\n\n"
-                "Dica: responda tocando nas opcoes quando possivel."
-            )
-            send_text_message(from_number, guide)
-            if ctx.get("last_menu"): _resend_last_menu(from_number, ctx)
-            return {"status": "handled"}
-        if cmd == "status":
-            st_map = {
-                "await_city": "Aguardando seleção de cidade",
-                "req_moto": "Confirmando: moto com documentação em dia",
-                "req_cnh": "Confirmando: CNH A ativa",
-                "req_android": "Confirmando: dispositivo Android",
-                "disc_q0": "Questionário DISC (1/5)",
-                "disc_q1": "Questionário DISC (2/5)",
-                "disc_q2": "Questionário DISC (3/5)",
-                "disc_q3": "Questionário DISC (4/5)",
-                "disc_q4": "Questionário DISC (5/5)",
-                "offer_positions": "Apresentando vagas disponíveis",
-                "final": "Atendimento concluído",
-            }
-            nome = ctx.get("nome") or "Entregador(a)"
-            cidade = ctx.get("cidade") or "—"
-            reqs = [
-                f"Moto: {'Sim' if ctx.get('req_moto') else 'Não' if ctx.get('req_moto') is False else '—'}",
-                f"CNH A: {'Sim' if ctx.get('req_cnh') else 'Não' if ctx.get('req_cnh') is False else '—'}",
-                f"Android: {'Sim' if ctx.get('req_android') else 'Não' if ctx.get('req_android') is False else '—'}",
-            ]
-            disc_prog = ctx.get("disc_answers") or []
-            vaga = ctx.get("vaga") or {}
-            msg = (
-                f"Status de {nome}:\n"
-                f"• Etapa: {st_map.get(str(ctx.get('stage') or ''), '—')}\n"
-                f"• Cidade: {cidade}\n"
-                f"• Requisitos: {', '.join(reqs)}\n"
-                f"• DISC: {len(disc_prog)}/5 respondidas\n"
-            )
-            if ctx.get('disc_score') is not None:
-                msg += f"• Pontuação DISC: {ctx.get('disc_score')}\n"
-            if ctx.get('analise_perfil'):
-                msg += f"• Análise de Perfil:\n{ctx.get('analise_perfil')}\n"
-            msg += "\nDicas: digite 'menu' para ver as opções, 'voltar' para a etapa anterior ou 'recomeçar' para iniciar do zero."
-            send_text_message(from_number, msg)
-            if ctx.get("last_menu"):
-                _resend_last_menu(from_number, ctx)
-            return {"status": "handled"}
-        if cmd == "humano":
-            send_text_message(from_number, "Sem problemas! Vou pedir para nossa equipe te chamar. Você também pode preencher o formulário: https://app.pipefy.com/public/form/v2m7kpB-")
-            _save_lead_record(from_number)
-            ctx["stage"] = "final"; _save_ctx(from_number, ctx)
-            return {"status": "handled"}
+async def _require_internal_auth(
+    creds: Optional[HTTPAuthorizationCredentials] = Depends(_bearer),
+) -> None:
+    """Exige ``Bearer <INTERNAL_API_TOKEN>`` quando o token está configurado."""
+    if not _INTERNAL_API_TOKEN:
+        return
+    if creds is None:
+        raise HTTPException(status_code=401, detail="Missing Bearer token")
+    # Comparação em tempo constante: não vaza quantos caracteres conferem.
+    if not hmac.compare_digest(creds.credentials.encode(), _INTERNAL_API_TOKEN.encode()):
+        raise HTTPException(status_code=403, detail="Invalid token")
 
-        try:
-            st_local = str(ctx.get("stage") or ""); handled = {"handled": False}; handled = _handle_city_selection(from_number, from_number, texto_usuario) if st_local == "await_city" else (_handle_city_selection_reject(from_number, from_number, texto_usuario) if st_local == "await_city_reject" else {"handled": False})
-            if handled.get("handled"):
-                return {"status": "handled"}
-        except Exception as sel_exc:
-            print(f"city selection handler error: {sel_exc}")
+def _send_endpoint(fn: Callable[..., Awaitable[Any]]) -> Callable[..., Awaitable[Any]]:
+    """Converte falhas de envio em ``HTTPException`` (status/corpo do WhatsApp ou 500).
 
+    ``functools.wraps`` preserva a assinatura, então o FastAPI continua vendo o payload.
+    """
+    @functools.wraps(fn)
+    async def wrapper(*args: Any, **kwargs: Any) -> Any:
         try:
-            if stage.startswith("intro_"):
-                yn = _normalize_yes_no(_strip_accents(texto_usuario))
-                if yn is True:
-                    ctx["stage"] = "await_city"
-                    ctx["from_intro"] = True
-                    _save_ctx(from_number, ctx)
-                    _send_city_menu(from_number, from_number, ctx=ctx)
-                    return {"status": "handled"}
-                if yn is False:
-                    send_text_message(from_number, "Tudo bem. Fico a disposição para futuras oportunidades. Obrigada!")
-                    ctx["stage"] = "final"
-                    _save_ctx(from_number, ctx)
-                    return {"status": "handled"}
-                _resend_last_menu(from_number, ctx)
-                return {"status": "handled"}
-
-            if stage == "req_moto":
-                yn = _normalize_yes_no(_strip_accents(texto_usuario))
-                if yn is not None:
-                    ctx["req_moto"] = bool(yn)
-                    ctx["stage"] = "req_cnh"
-                    _save_ctx(from_number, ctx)
-                    send_text_message(from_number, "Ótimo, obrigada pela confirmação.")
-                    _send_requirement_question(from_number, "req_cnh", user_id=from_number)
-                    return {"status": "handled"}
-
-            if stage == "req_cnh":
-                yn = _normalize_yes_no(_strip_accents(texto_usuario))
-                if yn is not None:
-                    ctx["req_cnh"] = bool(yn)
-                    ctx["stage"] = "req_android"
-                    _save_ctx(from_number, ctx)
-                    send_text_message(from_number, "Perfeito, mais uma pergunta rápida.")
-                    _send_requirement_question(from_number, "req_android", user_id=from_number)
-                    return {"status": "handled"}
-
-            if stage == "req_android":
-                yn = _normalize_yes_no(_strip_accents(texto_usuario))
-                if yn is not None:
-                    ctx["req_android"] = bool(yn)
-                    if ctx.get("req_moto") and ctx.get("req_cnh") and ctx.get("req_android"):
-                        ctx["stage"] = "disc_q0"
-                        ctx["disc_answers"] = []
-                        _save_ctx(from_number, ctx)
-                        send_text_message(from_number, "Excelente! Agora vou fazer 5 perguntas rápidas para entender seu perfil.")
-                        _send_disc_question(from_number, 0, user_id=from_number)
-                    else:
-                        send_text_message(from_number, "Obrigada pelo interesse. No momento, os requisitos necessários não foram atendidos.")
-                        ctx["stage"] = "final"
-                        _save_ctx(from_number, ctx)
-                    return {"status": "handled"}
-
-            if stage and stage.startswith("disc_q"):
-                try:
-                    q_idx = int(stage.replace("disc_q", ""))
-                except Exception:
-                    q_idx = 0
-                ans_id = _map_disc_selection(q_idx, texto_usuario)
-                if ans_id:
-                    answers = ctx.get("disc_answers") or []
-                    answers.append(ans_id)
-                    ctx["disc_answers"] = answers
-                    if q_idx + 1 < len(_DISC_QUESTIONS):
-                        ctx["stage"] = f"disc_q{q_idx+1}"
-                        _save_ctx(from_number, ctx)
-                        _send_disc_question(from_number, q_idx+1, user_id=from_number, ctx=ctx)
-                    else:
-                        score = sum(_DISC_SCORES.get(a, 0) for a in answers)
-                        ctx["disc_score"] = score
-                        trait_scores = {"D": 0, "I": 0, "S": 0, "C": 0}
-                        for ans_id in answers:
-                            traits = _DISC_TRAIT_SCORES.get(ans_id, {})
-                            for trait, points in traits.items():
-                                trait_scores[trait] += points
-                        ctx["disc_trait_scores"] = trait_scores
-                        profile_desc = "Perfil do Candidato:\n"
-                        for trait, score in trait_scores.items():
-                            profile_desc += f"- {trait}: {score} pontos\n"
-                        dominant_traits = [t for t, s in trait_scores.items() if s == max(trait_scores.values())]
-                        if dominant_traits:
-                            profile_desc += "\nTraços dominantes: " + ", ".join(dominant_traits) + ".\n"
-                            if "D" in dominant_traits: profile_desc += "Indica foco em resultados e proatividade.\n"
-                            if "I" in dominant_traits: profile_desc += "Indica habilidade de comunicação e persuasão.\n"
-                            if "S" in dominant_traits: profile_desc += "Indica estabilidade e paciência.\n"
-                            if "C" in dominant_traits: profile_desc += "Indica atenção a detalhes e conformidade.\n"
-                        else:
-                            profile_desc += "Não foi possível identificar traços dominantes claros.\n"
-                        ctx["analise_perfil"] = profile_desc
-                        aprovado = score >= 3
-                        ctx["aprovado"] = aprovado
-                        _save_ctx(from_number, ctx)
-                        if aprovado:
-                            send_text_message(from_number, "Parabéns! Você foi aprovado(a).")
-                            _send_vagas_menu(from_number, ctx.get("cidade") or "")
-                            ctx["stage"] = "offer_positions"
-                            _save_ctx(from_number, ctx)
-                        else:
-                            send_text_message(from_number, "Obrigado por participar. Neste momento, não seguiremos adiante.")
-                            ctx["stage"] = "final"
-                            _save_ctx(from_number, ctx)
-                    return {"status": "handled"}
-
-            if stage == "offer_positions":
-                cidade = ctx.get("cidade") or ""
-                vaga = _find_vaga_by_row_title(cidade, texto_usuario)
-                if vaga:
-                    ctx["vaga"] = {
-                        "VAGA_ID": vaga.get("VAGA_ID") or vaga.get("vaga_id"),
-                        "FARMACIA": vaga.get("FARMACIA") or vaga.get("farmacia"),
-                        "TURNO": vaga.get("TURNO") or vaga.get("turno"),
-                        "TAXA_ENTREGA": vaga.get("TAXA_ENTREGA") or vaga.get("taxa_entrega"),
-                    }
-                    _save_ctx(from_number, ctx)
-                    link_url = "https://app.pipefy.com/public/form/v2m7kpB-"
-                    det_vid = ctx["vaga"].get("VAGA_ID")
-                    det_farm = ctx["vaga"].get("FARMACIA")
-                    det_turno = ctx["vaga"].get("TURNO")
-                    det_taxa = ctx["vaga"].get("TAXA_ENTREGA")
-                    send_text_message(from_number, (
-                        f"Vaga selecionada:\n"
-                        f"• ID: {det_vid}\n• Farmácia: {det_farm}\n• Turno: {det_turno}\n• Taxa: {det_taxa}"
-                    ))
-                    send_text_message(from_number, (
-                        f"Excelente! Sua manifestação de interesse na vaga ID {det_vid} foi registrada com sucesso.\n"
-                        f"Para dar o próximo passo em sua jornada de associação à CoopMob, por favor, preencha o formulário de cadastro: {link_url}.\n\n"
-                        "Nossa equipe entrará em contato em breve para dar continuidade ao seu processo de ingresso na cooperativa. Agradecemos seu interesse em fazer parte da nossa comunidade de entregadores cooperados!"
-                    ))
-                    _save_lead_record(from_number)
-                    ctx["stage"] = "final"
-                    _save_ctx(from_number, ctx)
-                    return {"status": "handled"}
-                else:
-                    send_text_message(from_number, "Não entendi a vaga selecionada. Por favor, escolha uma das opções do menu de vagas.")
-                    _send_vagas_menu(from_number, cidade, user_id=from_number, ctx=ctx)
-                    return {"status": "handled"}
+            return await fn(*args, **kwargs)
+        except HTTPException:
+            raise
+        except WhatsAppError as exc:
+            raise HTTPException(status_code=exc.status_code, detail=exc.body) from exc
         except Exception as exc:
-            print(f"flow error: {exc}")
+            raise HTTPException(status_code=500, detail=str(exc)) from exc
+    return wrapper
 
-        try:
-            st = str(stage or "")
-            deterministic = (
-                (not st)
-                or st.startswith("intro_")
-                or st in {"await_city", "req_moto", "req_cnh", "req_android", "offer_positions"}
-                or st.startswith("disc_q")
-            )
-            if deterministic:
-                if not _resend_last_menu(from_number, ctx):
-                    pass
-                return {"status": "handled"}
-        except Exception:
-            pass
-        try:
-            agent_response = await enviar_mensagem_ao_agente_async(from_number, texto_usuario, stage=stage)
-            processar_resposta_do_agente(from_number, agent_response)
-        except Exception as inner_exc:
-            print(f"Agent pipeline error: {inner_exc}")
-            try:
-                send_text_message(
-                    from_number,
-                    "Não consegui processar sua mensagem agora. Tente novamente em instantes.",
-                )
-            except Exception as send_err:
-                print(f"Fallback send error: {send_err}")
-        return {"status": "handled"}
-    except Exception as exc:
-        print(f"Webhook error: {exc}")
-        return {"status": "ignored", "error": str(exc)}
-
-# Test endpoints
 class SendTextRequest(BaseModel):
     to: str
     text: str
 
-@app.post("/send-text")
-def send_text_endpoint(payload: SendTextRequest, authorization: Optional[str] = Header(default=None)):
+@app.post("/send-text", dependencies=[Depends(_require_internal_auth)])
+@_send_endpoint
+async def send_text_endpoint(payload: SendTextRequest):
     """Endpoint opcional para disparar uma mensagem de texto de teste."""
-    required_token = os.environ.get("INTERNAL_API_TOKEN")
-    if required_token:
-        if not authorization or not authorization.startswith("Bearer "):
-            raise HTTPException(status_code=401, detail="Missing Bearer token")
-        token = authorization.split(" ", 1)[1]
-        if token != required_token:
-            raise HTTPException(status_code=403, detail="Invalid token")
+    await send_text_message_async(payload.to, payload.text)
+    return {"status": "sent"}
+
+def _parse_redis_url(redis_url: Optional[str]) -> Optional[Dict[str, Any]]:
+    """Resumo da REDIS_URL para diagnóstico (só indica o que está presente, sem segredos)."""
+    if not redis_url:
+        return None
     try:
-        send_text_message(payload.to, payload.text)
-        return {"status": "sent"}
-    except requests.HTTPError as http_err:
-        status = getattr(http_err.response, "status_code", 500)
-        detail = getattr(http_err.response, "text", str(http_err))
-        raise HTTPException(status_code=status, detail=detail)
-    except Exception as exc:
-        raise HTTPException(status_code=500, detail=str(exc))
+        u = urlparse(redis_url)
+        return {
+            "scheme": u.scheme,
+            "host_set": bool(u.hostname),
+            "port_set": bool(u.port),
+            "has_user": bool(u.username),
+            "has_password": bool(u.password),
+        }
+    except Exception:
+        return {"error": "invalid_url"}
 
-@app.get("/config-check")
-def config_check():
-    """Retorna o status das variáveis de ambiente críticas (sem expor segredos)."""
-    wa_token = os.environ.get("WHATSAPP_ACCESS_TOKEN")
-    wa_phone = os.environ.get("WHATSAPP_PHONE_NUMBER_ID")
+_REDIS_PARSED = _parse_redis_url(os.environ.get("REDIS_URL"))
+
+@functools.lru_cache(maxsize=1)
+def _config_snapshot() -> Dict[str, Any]:
+    """Status das variáveis de ambiente críticas; o ambiente não muda com o processo rodando."""
     verify = os.environ.get("VERIFY_TOKEN")
     api_key = os.environ.get("GOOGLE_API_KEY")
     use_vertex = os.environ.get("GOOGLE_GENAI_USE_VERTEXAI")
@@ -1418,27 +2040,12 @@ def config_check():
     internal_token = os.environ.get("INTERNAL_API_TOKEN")
     port = os.environ.get("PORT")
 
-    phone_is_digits = bool(wa_phone and wa_phone.isdigit())
-    redis_parsed = None
-    if redis_url:
-        try:
-            u = urlparse(redis_url)
-            redis_parsed = {
-                "scheme": u.scheme,
-                "host_set": bool(u.hostname),
-                "port_set": bool(u.port),
-                "has_user": bool(u.username),
-                "has_password": bool(u.password),
-            }
-        except Exception:
-            redis_parsed = {"error": "invalid_url"}
-
     return {
         "status": "ok",
         "whatsapp": {
-            "access_token_set": bool(wa_token),
-            "phone_number_id_set": bool(wa_phone),
-            "phone_number_id_digits": phone_is_digits,
+            "access_token_set": bool(_WA_TOKEN),
+            "phone_number_id_set": bool(_WA_PHONE_ID),
+            "phone_number_id_digits": _WA_PHONE_DIGITS,
             "verify_token_set": bool(verify),
         },
         "google_genai": {
@@ -1447,7 +2054,7 @@ def config_check():
         },
         "redis": {
             "redis_url_set": bool(redis_url),
-            "parsed": redis_parsed,
+            "parsed": _REDIS_PARSED,
         },
         "internal_api": {
             "internal_api_token_set": bool(internal_token),
@@ -1457,13 +2064,29 @@ def config_check():
         },
     }
 
-@app.get("/llm-ping")
-def llm_ping():
+@app.get("/config-check", include_in_schema=False)
+async def config_check():
+    """Retorna o status das variáveis de ambiente críticas (sem expor segredos)."""
+    return _config_snapshot()
+
+# Pings simultâneos compartilham a mesma chamada em andamento ao Gemini.
+_LLM_PING_TASK: Optional["asyncio.Task[Dict[str, Any]]"] = None
+
+@app.get("/llm-ping", include_in_schema=False)
+async def llm_ping():
     """Executa uma chamada mínima ao modelo Gemini para verificar conectividade."""
+    global _LLM_PING_TASK
+    if _LLM_PING_TASK is None or _LLM_PING_TASK.done():
+        _LLM_PING_TASK = asyncio.create_task(_llm_ping_once())
+    # shield: um cliente que desconecta não cancela a chamada dos outros.
+    return await asyncio.shield(_LLM_PING_TASK)
+
+async def _llm_ping_once() -> Dict[str, Any]:
     try:
         model_name = AGENT_MODEL
-        model = genai.GenerativeModel(model_name)
-        resp = model.generate_content("ping")
+        model = _generative_model(model_name)
+        async with _GEMINI_SEM:
+            resp = await model.generate_content_async("ping")
         out = getattr(resp, "text", None)
         return {
             "status": "ok",
@@ -1482,68 +2105,81 @@ class SendButtonsRequest(BaseModel):
     body: str
     buttons: List[str]
 
-@app.post("/send-buttons")
-def send_buttons_endpoint(payload: SendButtonsRequest, authorization: Optional[str] = Header(default=None)):
+    @field_validator("buttons", mode="before")
+    @classmethod
+    def _clean_buttons(cls, value: Any) -> List[str]:
+        """Descarta rótulos vazios/não-texto e corta no máximo de 3 botões do WhatsApp."""
+        btns = [b.strip() for b in (value or []) if isinstance(b, str) and b.strip()][:3]
+        if not btns:
+            raise ValueError("buttons must be a non-empty list of labels")
+        return btns
+
+@app.post("/send-buttons", dependencies=[Depends(_require_internal_auth)])
+@_send_endpoint
+async def send_buttons_endpoint(payload: SendButtonsRequest):
     """Endpoint para disparar mensagem com botões (máx 3) para testes."""
-    required_token = os.environ.get("INTERNAL_API_TOKEN")
-    if required_token:
-        if not authorization or not authorization.startswith("Bearer "):
-            raise HTTPException(status_code=401, detail="Missing Bearer token")
-        token = authorization.split(" ", 1)[1]
-        if token != required_token:
-            raise HTTPException(status_code=403, detail="Invalid token")
-
-    btns = [b.strip() for b in (payload.buttons or []) if isinstance(b, str) and b.strip()]
-    if not btns:
-        raise HTTPException(status_code=400, detail="buttons must be a non-empty list of labels")
-    if len(btns) > 3:
-        btns = btns[:3]
-    try:
-        send_button_message(payload.to, payload.body, btns)
-        return {"status": "sent", "buttons": btns}
-    except requests.HTTPError as http_err:
-        status = getattr(http_err.response, "status_code", 500)
-        detail = getattr(http_err.response, "text", str(http_err))
-        raise HTTPException(status_code=status, detail=detail)
-    except Exception as exc:
-        raise HTTPException(status_code=500, detail=str(exc))
-
-@app.get("/agent-ping")
-def agent_ping(user_id: Optional[str] = None, text: Optional[str] = None):
+    await send_button_message_async(payload.to, payload.body, payload.buttons)
+    return {"status": "sent", "buttons": payload.buttons}
+
+# Monitores repetem o mesmo ping: guarda só respostas "ok" por (user_id, texto), em ordem de inserção.
+_PING_CACHE: "OrderedDict[Tuple[str, str], Tuple[float, Dict[str, Any]]]" = OrderedDict()
+_PING_CACHE_TTL_SEC = float(os.environ.get("AGENT_PING_CACHE_TTL", "30"))
+_PING_CACHE_MAX = 128
+# Mensagem padrão do ping (não é alterada pelo Runner): montada uma vez.
+_PING_CONTENT = genai_types.Content(parts=[genai_types.Part(text="ping")])
+
+@app.get("/agent-ping", include_in_schema=False)
+async def agent_ping(user_id: Optional[str] = None, text: Optional[str] = None):
     """Passa uma mensagem simples ao agente via Runner e retorna o texto final."""
     if not _runner or not _session_service:
         return {"status": "error", "error": "Agent runner not initialized"}
     uid = user_id or "diagnostic-user"
     msg = text or "ping"
+    key = (uid, msg)
+    hit = _PING_CACHE.get(key)
+    if hit is not None and time.monotonic() - hit[0] < _PING_CACHE_TTL_SEC:
+        return hit[1]
     try:
-        try:
-            _ = _session_service.get_session_sync(app_name=_APP_NAME, user_id=uid, session_id=uid)
-        except Exception:
-            _ = None
-        if not _:
-            _session_service.create_session_sync(app_name=_APP_NAME, user_id=uid, session_id=uid)
+        await _ensure_agent_session(uid)
 
-        content = genai_types.Content(parts=[genai_types.Part(text=msg)])
-        last_text = None
+        content = _PING_CONTENT if msg == "ping" else genai_types.Content(parts=[genai_types.Part(text=msg)])
+        last_texts: List[str] = []
         count = 0
-        for event in _runner.run(user_id=uid, session_id=uid, new_message=content):
-            count += 1
-            try:
-                if getattr(event, "author", "user") != "user" and getattr(event, "content", None):
-                    parts = getattr(event.content, "parts", None) or []
-                    texts = [getattr(p, "text", None) for p in parts if getattr(p, "text", None)]
-                    if texts:
-                        last_text = "\n".join(texts).strip()
-            except Exception:
-                pass
-        return {"status": "ok", "events": count, "text": last_text}
+        # Diagnóstico: a resposta final do agente encerra o ping; fecha o gerador em vez de drená-lo.
+        async with aclosing(_runner.run_async(user_id=uid, session_id=uid, new_message=content)) as events:
+            async for event in events:
+                count += 1
+                texts = _event_texts(event)
+                if texts:
+                    last_texts = texts
+                if texts and event.is_final_response():
+                    break
+        last_text = "\n".join(last_texts).strip() if last_texts else None
+        result = {"status": "ok", "events": count, "text": last_text}
     except Exception as exc:
+        # Sessão pode ter sumido (TTL/reinício do Redis): o próximo ping verifica de novo.
+        _KNOWN_SESSIONS.discard(uid)
         return {"status": "error", "error": str(exc)}
+    if _PING_CACHE_TTL_SEC > 0:
+        _PING_CACHE[key] = (time.monotonic(), result)
+        _PING_CACHE.move_to_end(key)
+        while len(_PING_CACHE) > _PING_CACHE_MAX:
+            _PING_CACHE.popitem(last=False)
+    return result
 
 if __name__ == "__main__":
     import uvicorn
     port = int(os.environ.get("PORT", 8080))
-    uvicorn.run(app, host="0.0.0.0", port=port)
+    # uvloop/httptools vêm com uvicorn[standard]; sem access log síncrono por requisição.
+    uvicorn.run(
+        "services.whatsapp:app",
+        host="0.0.0.0",
+        port=port,
+        loop="uvloop",
+        http="httptools",
+        workers=int(os.environ.get("WEB_CONCURRENCY", "1")),
+        access_log=False,
+    )
 
 
 